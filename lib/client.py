@@ -0,0 +1,114 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Thin client for the 'it serve' daemon.
+#
+# This module is imported before anything else of git-it, so it must stay
+# cheap to load: it does not use GitPython and only locates the repository
+# by looking at the file system. The socket and json modules are only
+# imported once there is a daemon to talk to.
+#
+import os, sys
+import it
+
+# Gitit methods that may be run by the daemon instead of in-process
+SERVED_CALLS = [ 'list', 'show', 'search' ]
+
+
+def find_git_dir(path = None):
+    """ Returns the .git directory of the repository containing `path` (the
+        current directory by default), or None if there is none.
+    """
+    if os.environ.get('GIT_DIR'):
+        return os.environ['GIT_DIR']
+
+    path = os.path.abspath(path or os.getcwd())
+    while True:
+        dotgit = os.path.join(path, '.git')
+        if os.path.isdir(dotgit):
+            return dotgit
+        if os.path.isfile(dotgit):
+            # a 'gitdir: <path>' link file, as used by worktrees and submodules
+            f = open(dotgit)
+            try:
+                line = f.readline().strip()
+            finally:
+                f.close()
+            if line.startswith('gitdir:'):
+                return os.path.join(path, line[len('gitdir:'):].strip())
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def socket_path(git_dir):
+    return os.path.join(git_dir, it.SOCKET_FILE)
+
+
+def terminal_width():
+    """ Returns the width of the terminal on stdout, or None.
+    """
+    try:
+        import fcntl, termios, struct
+        rows, cols = struct.unpack('hh',
+                fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234'))
+        return cols or None
+    except Exception:
+        return None
+
+
+def connect(git_dir):
+    """ Returns a socket connected to the daemon serving `git_dir`, or None
+        if no daemon is running.
+    """
+    if git_dir is None or not os.path.exists(socket_path(git_dir)):
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(git_dir))
+    except socket.error:
+        # stale socket of a daemon that went away
+        sock.close()
+        return None
+    return sock
+
+
+def call(name, args):
+    """ Runs Gitit.<name>(*args) in the daemon of the current repository.
+        Returns an (output, errors, exit status) tuple, or None if no daemon
+        is running, in which case the caller should run the call itself.
+    """
+    if name not in SERVED_CALLS:
+        return None
+    sock = connect(find_git_dir())
+    if sock is None:
+        return None
+
+    import socket, json
+
+    try:
+        try:
+            request = { 'call': name, 'args': list(args),
+                        'width': terminal_width() }
+            sock.sendall(json.dumps(request).encode('utf-8'))
+            sock.shutdown(socket.SHUT_WR)
+            data = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data.append(chunk)
+            reply = json.loads(b''.join(data).decode('utf-8'))
+        except (socket.error, ValueError):
+            # the daemon went away halfway; run in-process
+            return None
+    finally:
+        sock.close()
+    out, err = reply['out'], reply['err']
+    if not isinstance(out, str):
+        # Python 2: write the output as the bytes the daemon produced
+        out, err = out.encode('utf-8'), err.encode('utf-8')
+    return out, err, reply['status']
+
+#EOF
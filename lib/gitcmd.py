@@ -0,0 +1,99 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Accounting of the git commands git-it runs.
+#
+# Every git command goes through repo.git, so Gitit opens its repository as
+# a gitcmd.Repo, whose Git wrapper records each command it spawns, with its
+# duration and the size of its output. Requests to the persistent 'git
+# cat-file' processes are recorded separately, as they do not spawn anything.
+#
+# Set $IT_GIT_STATS to get a summary on stderr after each subcommand, and
+# $IT_GIT_LIMIT to make a subcommand fail when it spawns more git processes
+# than that, which catches regressions like a new git call per ticket.
+#
+import os, sys
+import time
+import git
+import log
+
+# (command line, seconds, output bytes) per spawned git process
+spawned = []
+
+# [count, seconds, bytes] of the requests to persistent cat-file processes
+requests = [0, 0.0, 0]
+
+
+def output_size(result):
+    if isinstance(result, tuple):
+        # with_extended_output: (status, stdout, stderr)
+        result = result[1]
+    if isinstance(result, (bytes, type(u''))):
+        return len(result)
+    return 0
+
+
+class Git(git.Git):
+    def execute(self, command, *args, **kwargs):
+        start = time.time()
+        result = None
+        try:
+            result = git.Git.execute(self, command, *args, **kwargs)
+        finally:
+            # for as_process calls this is the time to start the process only
+            spawned.append((list(command), time.time() - start, output_size(result)))
+        return result
+
+    def get_object_header(self, ref):
+        start = time.time()
+        result = git.Git.get_object_header(self, ref)
+        requests[0] += 1
+        requests[1] += time.time() - start
+        return result
+
+    def stream_object_data(self, ref):
+        start = time.time()
+        result = git.Git.stream_object_data(self, ref)
+        requests[0] += 1
+        requests[1] += time.time() - start
+        requests[2] += result[2]
+        return result
+
+
+class Repo(git.Repo):
+    GitCommandWrapperType = Git
+
+
+def summary():
+    """ Returns a one-line summary of the git commands run so far.
+    """
+    return 'git: %d processes, %.1f ms, %d bytes; %d cat-file requests, %.1f ms, %d bytes' % (
+            len(spawned), sum([s for _, s, _ in spawned]) * 1000,
+            sum([n for _, _, n in spawned]),
+            requests[0], requests[1] * 1000, requests[2])
+
+
+def report(stream = None):
+    """ Writes the summary and all spawned git commands to `stream`.
+    """
+    stream = stream or sys.stderr
+    stream.write(summary() + '\n')
+    for command, seconds, size in spawned:
+        stream.write('  %8.1f ms %9d bytes  %s\n' % (seconds * 1000, size,
+                ' '.join(command)))
+
+
+def finish(stats = False):
+    """ Reports on and checks the git commands run by this process, as
+        requested through `stats`, $IT_GIT_STATS and $IT_GIT_LIMIT.
+    """
+    if stats or os.environ.get('IT_GIT_STATS', '') not in [ '', '0' ]:
+        report()
+    limit = os.environ.get('IT_GIT_LIMIT')
+    if limit and len(spawned) > int(limit):
+        log.printerr("Spawned %d git processes, more than IT_GIT_LIMIT=%s:" %
+                (len(spawned), limit))
+        for command, _, _ in spawned:
+            log.printerr('  ' + ' '.join(command))
+        sys.exit(1)
+
+#EOF
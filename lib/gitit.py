@@ -1,9 +1,14 @@
 #vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
 
 import sys, os, re
+import random
+import time
+import getpass
 import datetime
 from tempfile import mkstemp
-import misc, log, ticket, colors, it
+import misc, log, ticket, colors, it, itdb, itindex, itheaders, ittable, itpack, timing, gitcmd
+# The modules that only some subcommands need, like itlog, search or query,
+# are imported in the methods that use them
 
 from git import *
 
@@ -19,25 +24,42 @@ except ImportError:
     sha1_constructor = sha.new
 
 
-def cmp_by_prio(t1, t2):
-    return cmp(t1.prio, t2.prio)
+# Operations understood by 'it batch', with their arguments after the id
+BATCH_OPERATIONS = { 'close': [], 'fix': [], 'reject': [], 'test': [],
+                     'reopen': [], 'take': [], 'leave': [],
+                     'mv': ['<release>'], 'rm': [] }
+FINISH_STATUS = { 'close': 'closed', 'fix': 'fixed', 'reject': 'rejected',
+                  'test': 'test' }
 
 
-def cmp_by_date(t1, t2):
-    if t1.date < t2.date:
-        return -1
-    elif t1.date > t2.date:
-        return 1
-    else:
-        return 0
+class BatchOperationException(Exception): pass
 
 
-def cmp_by_prio_then_date(ticket1, ticket2):
-    v = cmp_by_prio(ticket1, ticket2)
-    if v == 0:
-        return cmp_by_date(ticket1, ticket2)
-    else:
-        return v
+# How often a commit is redone on top of commits of concurrent writers, and
+# the longest time in seconds to back off before the next attempt
+COMMIT_ATTEMPTS = 20
+COMMIT_BACKOFF = 0.5
+
+# The order of 'it list' without --sort, see ittable.TicketTable.sort
+DEFAULT_ORDER = [ 'prio', 'date' ]
+
+
+def matching_rows(headers, rows, match):
+    """ Returns the `rows` of the header cache `headers` whose tickets satisfy
+        the query predicate `match` (see query.compile).
+    """
+    return [row for row in rows if match(headers.id(row), headers.release(row),
+                                         headers.fields(row))]
+
+
+def new_ticket_id(i, user):
+    """ Returns a fresh SHA1 id for the new ticket `i` of the OS user `user`.
+    """
+    s = sha1_constructor()
+    s.update(i.__str__())
+    s.update(user)
+    s.update(datetime.datetime.now().__str__())
+    return s.hexdigest()
 
 
 def versionCmp(strx, stry):
@@ -67,9 +89,7 @@ def versionCmp(strx, stry):
     return cmp(x, y)
 
 
-def cmp_by_release_dir(dir1, dir2):
-    _, _, _, title1 = dir1
-    _, _, _, title2 = dir2
+def cmp_by_release(title1, title2):
     if title1 ==  it.UNCATEGORIZED:
         return -1
     elif title2 == it.UNCATEGORIZED:
@@ -78,23 +98,112 @@ def cmp_by_release_dir(dir1, dir2):
         return -versionCmp(title1, title2)
 
 
-class Gitit:
+class Gitit(object):
     def __init__(self):
+        with timing.phase('repo open'):
+            try:
+                self.repo = gitcmd.Repo()
+            except InvalidGitRepositoryError:
+                log.printerr("Not a valid Git repository.")
+                sys.exit(1)
+
+            # get config reader direct from git.Repo()
+            self._gitcfg = self.repo.config_reader()
+
+        self._index = None
+        self._headers = None
+        self._table = None
+        # the itdb commit the first tickets were read from; changes made
+        # to them are redone on top of what other writers committed since
+        self._base = None
+        self._search_index = None
+        # (blob sha, contents) of the last pack read by read_pack()
+        self._pack = None
+
+        # Terminal width to render for; probed when not set
+        self.term_width = None
+
+
+    def reload_config(self):
+        """ Reads the git config again, for processes like 'it serve' that
+            live longer than the values they read from it.
+        """
+        self._gitcfg = self.repo.config_reader()
+
+
+    def load_index(self, jobs = 1, save = True):
+        """ Returns the ticket index, brought up to date with the itdb branch
+            by `jobs` processes. Returns None if there is no itdb branch. The
+            updated index is only written to disk if `save` is set.
+        """
         try:
-            self.repo = Repo()
-        except InvalidGitRepositoryError:
-            log.printerr("Not a valid Git repository.")
-            sys.exit(1)
+            head = self.repo.heads[it.ITDB_BRANCH].commit.hexsha
+        except IndexError:
+            return None
 
-        self.itdb_tree = None
+        if self._base is None:
+            self._base = head
+        if self._index is None:
+            self._index = itindex.TicketIndex(
+                    os.path.join(self.repo.git_dir, it.INDEX_FILE))
+            self._index.load()
+        if self._index.update(self.repo, head, self.read_blob, jobs) and save:
+            self._index.save()
+        return self._index
+
+
+    def load_headers(self, jobs = 1):
+        """ Returns the memory-mapped ticket header cache of the itdb branch,
+            or None if there is no itdb branch. Only when the branch moved,
+            the ticket index is updated (see load_index) to rebuild it.
+        """
         try:
-            self.itdb_tree = self.repo.heads[it.ITDB_BRANCH] \
-                    .commit.tree[it.TICKET_DIR]
+            head = self.repo.heads[it.ITDB_BRANCH].commit.hexsha
         except IndexError:
-            pass
+            return None
 
-        # get config reader direct from git.Repo()
-        self._gitcfg = self.repo.config_reader()
+        if self._base is None:
+            self._base = head
+        if self._headers is None or self._headers.commit != head:
+            headers = itheaders.HeaderCache(
+                    os.path.join(self.repo.git_dir, it.HEADERS_FILE))
+            if not headers.open(head):
+                index = self.load_index(jobs)
+                with timing.phase('headers'):
+                    headers.build(index)
+            self._headers = headers
+        return self._headers
+
+
+    def load_table(self, jobs = 1):
+        """ Returns the columnar ticket table of the header cache (see
+            load_headers), or None if there is no itdb branch.
+        """
+        headers = self.load_headers(jobs)
+        if headers is None:
+            return None
+        if self._table is None or self._table.commit != headers.commit:
+            self._table = ittable.TicketTable(headers)
+        return self._table
+
+
+    def load_search_index(self):
+        """ Returns the full-text search index, brought up to date with the
+            itdb branch. Returns None if there is no itdb branch.
+        """
+        import search
+        try:
+            head = self.repo.heads[it.ITDB_BRANCH].commit.hexsha
+        except IndexError:
+            return None
+
+        if self._search_index is None:
+            self._search_index = search.SearchIndex(
+                    os.path.join(self.repo.git_dir, it.SEARCH_FILE))
+            self._search_index.load()
+        if self._search_index.update(self.repo, head, self.read_blob):
+            self._search_index.save()
+        return self._search_index
 
 
     def get_cfg(self, key, section='core', default=None):
@@ -109,6 +218,50 @@ class Gitit:
         return value
 
 
+    def read_blob(self, ref):
+        """ Returns the contents of the blob `ref` (a SHA or '<rev>:<path>').
+
+            All blobs are read through the single persistent 'git cat-file
+            --batch' process GitPython keeps per repository, so reading many
+            tickets does not spawn a git process per ticket.
+        """
+        with timing.phase('blob reads'):
+            _, _, _, contents = self.repo.git.get_object_data(ref)
+        return contents
+
+
+    def read_pack(self, blob):
+        """ Returns the contents of the pack blob `blob`. The last pack read
+            is kept, as the tickets worked on together tend to share it.
+        """
+        if self._pack is None or self._pack[0] != blob:
+            self._pack = (blob, self.read_blob(blob))
+        return self._pack[1]
+
+
+    def read_packed(self, blob, span):
+        """ Returns the ticket at `span`, an (offset, length), in the pack
+            blob `blob`.
+        """
+        offset, length = span
+        return self.read_pack(blob)[offset:offset + length]
+
+
+    def body_loader(self, blob, span = None):
+        """ Returns a callable that reads the body of the ticket blob `blob`,
+            for tickets that were parsed header-only. For a packed ticket,
+            `blob` is its pack and `span` its (offset, length) in there.
+        """
+        def load():
+            if span is not None:
+                contents = self.read_packed(blob, span)
+            else:
+                contents = self.read_blob(blob)
+            with timing.phase('parse'):
+                return ticket.parse_body(contents)
+        return load
+
+
     def itdb_exists(self, with_remotes=False):
         if with_remotes:
             branches = [it.ITDB_BRANCH, 'remotes/origin/' + it.ITDB_BRANCH, None]
@@ -121,12 +274,9 @@ class Gitit:
         if branch == None:
             return False
 
-        # look for the hold file in the file list
-        abs_hold_file = os.path.join(it.TICKET_DIR, it.HOLD_FILE)
-        ls = [x.path for x in self.itdb_tree.list_traverse(depth=1)]
-        if abs_hold_file in ls:
-            return True
-        return False
+        # look for the hold file in the ticket header cache
+        headers = self.load_headers()
+        return headers is not None and headers.hold
 
 
     def require_itdb(self):
@@ -139,17 +289,133 @@ class Gitit:
             sys.exit(1)
 
 
+    def commit_changes(self, changes, msg, merge = None):
+        """ Commits `changes` (see itdb.write_tree) on top of the itdb branch,
+            creating the branch if it does not exist yet. The commit `merge`,
+            if given, becomes its second parent.
+
+            The commit is built in memory and the branch is advanced with
+            'git update-ref', so HEAD, the index and the working tree are
+            never touched. In the packed layout, the changed ticket paths
+            are turned into changes of the packs of their releases.
+
+            The branch is only advanced if no other process moved it since
+            the tickets were read. Otherwise, the ticket changes are redone
+            on top of the new commits (see __rebase) and committed again.
+            Raises an itmerge.MergeConflictException if another process
+            changed the same field of a ticket.
+
+            Processes take turns on itdb.commit_lock. The index is saved
+            before, so the attempts only bring it up to date in memory with
+            the tickets the other processes changed.
+        """
+        base = self._base
+        self.load_index()
+        with itdb.commit_lock(self.repo):
+            for attempt in range(COMMIT_ATTEMPTS):
+                index = self.load_index(save=False)
+                head = index is not None and index.commit or None
+                if base is not None and head != base:
+                    changes = self.__rebase(index, changes, base)
+                    if not changes:
+                        # another process made the same changes
+                        self._base = head
+                        return self.repo.commit(head)
+                base = head
+
+                tree_changes = changes
+                if index is not None and index.layout == it.PACKED_LAYOUT:
+                    tree_changes = self.__pack_changes(index, changes)
+                try:
+                    return self.__commit(tree_changes, msg, head, merge)
+                except itdb.BranchMovedException:
+                    # let the other writers finish instead of racing them again
+                    time.sleep(random.uniform(0, min(COMMIT_BACKOFF, 0.01 * 2 ** attempt)))
+        raise itdb.BranchMovedException("'%s' kept being changed by other processes" \
+                % it.ITDB_BRANCH)
+
+
+    def __rebase(self, index, changes, base):
+        """ Returns the ticket `changes`, which were made on top of the commit
+            `base`, redone on top of the commit of `index`. A ticket that was
+            also changed since `base` is merged field by field (see itmerge),
+            and written to the path it has now.
+        """
+        import itmerge
+        if index is None:
+            raise itdb.BranchMovedException("'%s' was removed by another process" \
+                    % it.ITDB_BRANCH)
+        ours = {}
+        for path, contents in changes.items():
+            location = itindex.split_ticket_path(path)
+            if location is None:
+                raise itdb.BranchMovedException("'%s' was changed by another process" \
+                        % it.ITDB_BRANCH)
+            release, id, _ = location
+            if contents is not None:
+                ours[id] = (release, contents)
+            else:
+                ours.setdefault(id, None)
+
+        with timing.phase('merge'):
+            theirs = itmerge.changed_tickets(self.repo, self.read_blob, base, index.commit)
+            rebased = {}
+            for id, state in ours.items():
+                if id in theirs:
+                    base_state, head_state = theirs[id]
+                    try:
+                        state = itmerge.merge_states(id, base_state, head_state, state)
+                    except itmerge.MergeConflictException as e:
+                        raise itmerge.MergeConflictException(
+                                "ticket '%s' was changed by another process: %s" % (id[:7], e))
+                    if state == head_state:
+                        continue
+                if id in index.tickets:
+                    rebased[index.path(id)] = None
+                if state is not None:
+                    rebased[ticket.ticket_path(state[0], id, index.layout)] = state[1]
+        return rebased
+
+
+    def __pack_changes(self, index, changes):
+        packs = {}
+        packed = {}
+        for path, contents in changes.items():
+            location = itindex.split_ticket_path(path)
+            if location is None:
+                packed[path] = contents
+            else:
+                release, id, _ = location
+                packs.setdefault(release, {})[id] = contents
+        for release, records in packs.items():
+            blob = index.packs.get(release)
+            data = blob and self.read_pack(blob)
+            packed[itpack.pack_path(release)] = itpack.update(data, records)
+        return packed
+
+
+    def __commit(self, changes, msg, parent, merge = None):
+        """ Commits the tree `changes` on top of the commit `parent` (a hex
+            SHA, or None for the first commit) and advances the itdb branch
+            to it, if it still points to `parent`. Raises an
+            itdb.BranchMovedException if it does not.
+        """
+        with timing.phase('commit'):
+            commit = itdb.create_commit(self.repo, parent and self.repo.commit(parent),
+                    changes, msg, merge)
+            itdb.update_branch(self.repo, commit, msg, parent)
+        self._base = commit.hexsha
+        return commit
+
+
     def init(self):
         """ Initializes a ITDB if it does not exists. Otherwise search for
             a remote ITDB an branch from it.
         """
         # check wheter it is already initialzed
-        if it.ITDB_BRANCH in [b.name for b in self.repo.branches]:
-            # check for the hold file
-            abs_hold_file = os.path.join(it.TICKET_DIR, it.HOLD_FILE)
-            if abs_hold_file in [x.path for x in self.itdb_tree.list_traverse(depth=1)]:
-                print("Issue database already initialized.")
-                return
+        if self.itdb_exists():
+            print("Issue database already initialized.")
+            return
 
         # search for a ITDB on a remote branch
         for r in self.repo.remotes:
@@ -159,40 +425,17 @@ class Gitit:
                     self.repo.create_head( 'refs/heads/%s'%it.ITDB_BRANCH, ref.name)
                     return
 
-        # else, initialize the new .it database alongside the .git repo
-        gitrepo = self.repo.git_dir
-        if not gitrepo:
-            log.printerr("%s: Not a valid Git repository." % gitrepo)
-            return
-
-        #FIXME: use working_dir directly instead of assuming 'git_repo'
-        #       is work_dir/.git
-        parent, _ = os.path.split(gitrepo)
-        ticket_dir = os.path.join(parent, it.TICKET_DIR)
-        hold_file = os.path.join(ticket_dir, it.HOLD_FILE)
-        curr_branch = self.repo.active_branch.name
+        # else, initialize the new .it database in the repo
+        hold_file = os.path.join(it.TICKET_DIR, it.HOLD_FILE)
         msg = "Initialized empty ticket database."
-        abs_ticket_dir = os.path.join( self.repo.working_dir, it.TICKET_DIR)
         try:
-            misc.mkdirs(ticket_dir)
-            misc.write_file_contents(hold_file, \
+            self.commit_changes({hold_file: \
                          'This is merely a placeholder file for git-it that prevents ' + \
-                         'this directory from\nbeing pruned by Git.')
-
-            # Commit the new itdb to the repo
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+it.ITDB_BRANCH])
-            self.repo.git.add([hold_file])
-            self.repo.git.commit(['-m', msg, hold_file])
+                         'this directory from\nbeing pruned by Git.'}, msg)
             print("Initialized empty ticket database.")
-        except Exception:
-            log.printerr("Error initialising ticket database.")
-
-        finally:
-            os.remove(hold_file)
-            os.rmdir(ticket_dir)
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+curr_branch])
-            self.repo.git.reset(['HEAD', '--', abs_ticket_dir])
-            misc.rmdirs(abs_ticket_dir)
+        except Exception as e:
+            log.printerr("Error initialising ticket database: %s" % e)
+            sys.exit(1)
 
 
     def match_or_error(self, sha):
@@ -200,23 +443,18 @@ class Gitit:
         """
         self.require_itdb()
 
-        matches = []
-        for path in [x.path for x in self.itdb_tree.list_traverse()]:
-            _, file = os.path.split(path)
-            if file.startswith(sha):
-                matches.append(path)
-
+        headers = self.load_headers()
+        matches = headers.match(sha)
         if len(matches) == 0:
             log.printerr("No such ticket")
             sys.exit(1)
         elif len(matches) > 1:
             log.printerr("Ambiguous match criteria. The following tickets match:")
-            for match in matches:
-                _, id = os.path.split(match)
-                log.printerr(id)
+            for row in matches:
+                log.printerr(headers.id(row))
             sys.exit(1)
         else:
-            return matches[0]
+            return headers.path(matches[0])
 
 
     def edit(self, sha):
@@ -250,23 +488,15 @@ class Gitit:
             log.printerr("Error parsing ticket: %s" % e)
             sys.exit(1)
 
-        # Now, when the edit has succesfully taken place, switch branches, commit,
-        # and switch back
-        curr_branch = self.repo.active_branch.name
+        # Now, when the edit has succesfully taken place, commit it
         msg = "Ticket '%s' edited" % sha7
-        abs_ticket_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR)
         try:
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+it.ITDB_BRANCH])
-            i.save()
-            self.repo.git.commit(['-m', msg, i.filename()])
+            self.commit_changes({match: i.contents()}, msg)
             print("Ticket '%s' edited succesfully" % sha7)
-        except Exception:
-            log.printerr("Error commiting modified ticket.")
-
-        finally:
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+curr_branch])
-            self.repo.git.reset(['HEAD', '--', abs_ticket_dir])
-            misc.rmdirs(abs_ticket_dir)
+        except Exception as e:
+            log.printerr("Error commiting modified ticket: %s" % e)
+            log.printerr("The edited ticket is kept in '%s'." % filename)
+            sys.exit(1)
 
         # Remove the temporary file
         os.remove(filename)
@@ -277,81 +507,198 @@ class Gitit:
         i, rel, fullsha, src_path = self.get_ticket(sha)
         sha7 = misc.chop(fullsha, 7)
 
-        src_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR, rel)
-        target_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR, to_rel)
-        target_path = os.path.join(target_dir, fullsha)
-        if src_dir == target_dir:
+        target_path = ticket.ticket_path(to_rel, fullsha, self.load_index().layout)
+        if rel == to_rel:
             log.printerr("Ticket '%s' already in '%s'" % (sha7, to_rel))
             return
 
-        # Create the target dir, if neccessary
-        if not os.path.isdir(target_dir):
-            misc.mkdirs(target_dir)
-
-        # Try to move the file into it
-        curr_branch = self.repo.active_branch.name
+        # Move the ticket in a single commit
         msg = "Moved ticket '%s' (%s --> %s)" % (sha7, rel, to_rel)
-        abs_ticket_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR)
         try:
-            # Commit the new itdb to the repo
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+it.ITDB_BRANCH])
-
-            i.save(target_path)
-            if os.path.isfile(src_path):
-                os.remove(src_path)
-
-            self.repo.git.add([target_path])
-            self.repo.git.commit(['-m', msg, src_path, target_path])
+            self.commit_changes({src_path: None, target_path: i.contents()}, msg)
             print("Ticket '%s' moved to release '%s'" % (sha7, to_rel))
-        except OSError as e:
+        except Exception as e:
             log.printerr("Could not move ticket '%s' to '%s':" % (sha7, to_rel))
             log.printerr(e)
-        except Exception:
-            log.printerr("Could not move ticket '%s' to '%s':" % (sha7, to_rel))
-
-        finally:
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+curr_branch])
-            self.repo.git.reset(['HEAD', '--', abs_ticket_dir])
-            misc.rmdirs(abs_ticket_dir)
+            sys.exit(1)
 
 
     def show(self, sha):
         i, _, fullsha, _ = self.get_ticket(sha)
-        i.print_ticket(fullsha)
+        with timing.phase('render'):
+            i.print_ticket(fullsha)
+
+
+    def log(self, sha):
+        """ Prints the commits that changed a ticket, oldest first, with the
+            fields each of them changed.
+        """
+        import itlog
+        match = self.match_or_error(sha)
+        id = os.path.basename(match)
+        head = self.repo.heads[it.ITDB_BRANCH].commit.hexsha
+
+        cache = itlog.TicketLog(os.path.join(self.repo.git_dir, it.LOG_FILE))
+        cache.load()
+        history, changed = cache.history(self.repo, head, id, self.read_blob)
+        if changed:
+            cache.save()
+
+        with timing.phase('render'):
+            for commit, author, timestamp, subject, changes in history:
+                date = datetime.datetime.fromtimestamp(timestamp)
+                print("%s %s %s" % (commit[:7], date.strftime(ticket.DATE_FORMAT), author))
+                print("  %s" % subject)
+                for field, old, new in changes:
+                    if field == 'Release' and old is None:
+                        print("    Added to release %s" % new)
+                    elif field == 'Release' and new is None:
+                        print("    Removed from release %s" % old)
+                    elif field is None:
+                        print("    Body changed")
+                    else:
+                        print("    %s: %s -> %s" % (field, old, new))
+                print('')
+
+
+    def stats(self, weeks, releases_filter = []):
+        """ Prints the progress of the releases over the last `weeks` weeks:
+            the weight added and closed per week, the weight remaining at the
+            end of it and how long the tickets took to get closed.
+        """
+        import itstats
+        self.require_itdb()
+        head = self.repo.heads[it.ITDB_BRANCH].commit.hexsha
+        stats = itstats.ReleaseStats(os.path.join(self.repo.git_dir, it.STATS_FILE))
+        stats.load()
+        if stats.update(self.repo, head, self.read_blob):
+            stats.save()
+
+        releases = [r for r in stats.releases()
+                    if not releases_filter or r in releases_filter]
+        if not releases:
+            if releases_filter:
+                print("No tickets in %s." % ', '.join(releases_filter))
+            else:
+                print("No tickets yet. Use 'it new' to add new tickets.")
+            return
+        # The current counts come from the columns of the ticket table
+        table = self.load_table()
+        release_rows = table.group_by('release')
+        with timing.phase('render'):
+            for rel in releases:
+                rows = release_rows.get(rel, [])
+                counts = table.counts('status', rows)
+                open = sum([counts.get(s, 0) for s in ittable.OPEN_STATUSES])
+                rejected = sum([counts.get(s, 0) for s in ittable.UNCOUNTED_STATUSES])
+                done = len(rows) - open - rejected
+                total_weight, done_weight = table.progress(rows)
+                print("%-16s %d open, %d done, %d rejected; %d of %d weight done (%d%%)" % \
+                        (rel, open, done, rejected, done_weight, total_weight,
+                         total_weight and done_weight * 100 // total_weight))
+                print("  %-10s %7s %7s %7s %9s" % ('week', 'added', 'closed', 'tickets', 'remaining'))
+                for week, added, closed_weight, closed, remaining in stats.burndown(rel, weeks):
+                    print("  %-10s %+7d %7d %7d %9d" % (week, added, closed_weight, closed, remaining))
+                distribution = stats.close_time_distribution(rel)
+                if distribution is not None:
+                    buckets, median, p90 = distribution
+                    print("  time to close: median %.1f days, 90%% within %.1f days" % (median, p90))
+                    print("  closed within %s, later: %s" % (
+                        ', '.join(['%s: %d' % (name, n) for (_, name), n
+                                   in zip(itstats.CLOSE_BUCKETS, buckets)]), buckets[-1]))
+                print('')
 
 
     def sync(self):
-        # check whether this working tree has unstaged/uncommitted changes
-        # in order to prevent data loss from happening
-        if self.repo.is_dirty(index=False):
-            print("Current working tree has unstaged changes. Aborting.")
-            sys.exit(1)
-        if self.repo.is_dirty():
-            print("Current working tree has uncommitted changes. Aborting.")
-            sys.exit(1)
+        """ Fetches the itdb branch of 'origin', merges it into the local one
+            and pushes the result.
 
+            The merge is done ticket by ticket on the tree objects (see
+            itmerge), so HEAD, the index and the working tree are never
+            touched and may well be dirty. If both sides changed the same
+            field of a ticket, nothing is merged or pushed.
+        """
         remote = 'origin'
         remote_path = remote +'/'+ it.ITDB_BRANCH
+        if remote not in [r.name for r in self.repo.remotes]:
+            print("No remote branch for '%s'" % remote_path)
+            return
 
         try:
-            # check we have a remote branch available
-            if remote_path not in [x.name for x in self.repo.remotes[remote].refs]:
+            ours = self.repo.heads[it.ITDB_BRANCH].commit
+        except IndexError:
+            ours = None
+        try:
+            self.repo.git.fetch([remote, '+refs/heads/%s:refs/remotes/%s'
+                    % (it.ITDB_BRANCH, remote_path)])
+            theirs = self.repo.refs[remote_path].commit
+        except GitCommandError as e:
+            if "couldn't find remote ref" not in e.stderr:
+                log.printerr("Error fetching the ticket database: %s" % e)
+                sys.exit(1)
+            if ours is None:
                 print("No remote branch to pull from '%s'" % remote_path)
                 return
-        except AssertionError as e:
-            print("No remote branch for '%s'" % remote_path)
-            return
+            # the first sync publishes the local ticket database
+            theirs = None
+
+        base = ours and theirs and self.repo.merge_base(ours, theirs)
+        if ours is None or base == [ours]:
+            if ours != theirs:
+                itdb.update_branch(self.repo, theirs,
+                        "Fast-forwarded to '%s'" % remote_path, ours and ours.hexsha)
+                print("Fast-forwarded to '%s'" % remote_path)
+        elif theirs is not None and base != [theirs]:
+            self.__merge(base, ours, theirs, remote_path)
+
+        if self.repo.heads[it.ITDB_BRANCH].commit != theirs:
+            try:
+                self.repo.git.push([remote, '%s:%s' % (it.ITDB_BRANCH, it.ITDB_BRANCH)])
+            except GitCommandError as e:
+                log.printerr("Error pushing the ticket database: %s" % e)
+                sys.exit(1)
+            print("Pushed ticket changes to '%s'" % remote_path)
+        elif ours == theirs:
+            print("Ticket database is up to date with '%s'" % remote_path)
+
+
+    def __merge(self, base, ours, theirs, remote_path):
+        import itmerge
+        if not base:
+            log.printerr("The itdb branch and '%s' have no common history." % remote_path)
+            sys.exit(1)
+        if itmerge.commit_layout(ours) != itmerge.commit_layout(theirs):
+            log.printerr("'%s' uses the %s layout; run 'it migrate' to match it first." \
+                    % (remote_path, itmerge.commit_layout(theirs)))
+            sys.exit(1)
 
-        # now we may sync the git-it branch safely!
-        curr = self.repo.active_branch.name
+        with timing.phase('merge'):
+            try:
+                merged = itmerge.merge(self.repo, self.read_blob,
+                        base[0].hexsha, ours.hexsha, theirs.hexsha)
+            except itmerge.MergeConflictException as e:
+                log.printerr("Conflicting changes to tickets:")
+                log.printerr(str(e))
+                log.printerr("Nothing merged. Change these tickets to agree with '%s' and sync again." \
+                        % remote_path)
+                sys.exit(1)
+
+        layout = self.load_index().layout
+        changes = {}
+        for id, (old, new) in merged.items():
+            if old is not None:
+                changes[ticket.ticket_path(old[0], id, layout)] = None
+        for id, (old, new) in merged.items():
+            if new is not None:
+                changes[ticket.ticket_path(new[0], id, layout)] = new[1]
+        msg = "Merged ticket changes from '%s'\n\nChanged %d tickets." \
+                % (remote_path, len(merged))
         try:
-            self.repo.git.checkout([it.ITDB_BRANCH])
-            self.repo.remotes[remote].pull()
-            self.repo.remotes[remote].push()
+            self.commit_changes(changes, msg, theirs)
         except Exception as e:
-            log.printerr("Error pulling/pushing to ticket database: %s" % e)
-        finally:
-            self.repo.git.checkout([curr])
+            log.printerr("Error commiting merge: %s" % e)
+            sys.exit(1)
+        print("Merged %d ticket changes from '%s'" % (len(merged), remote_path))
 
 
     def new(self):
@@ -366,36 +713,109 @@ class Gitit:
             return None
 
         # Generate a SHA1 id
-        s = sha1_constructor()
-        s.update(i.__str__())
-        s.update(os.getlogin())
-        s.update(datetime.datetime.now().__str__())
-        i.id = ticketname = s.hexdigest()
-
-        # Save the ticket to disk
-        i.save()
-        sha7 = misc.chop(ticketname, 7)
-        print("New ticket '%s' saved" % sha7)
+        i.id = ticketname = new_ticket_id(i, getpass.getuser())
 
-        # Commit the new ticket to the 'aaa' branch
-        curr_branch = self.repo.active_branch.name
+        # Commit the new ticket to the itdb branch
+        sha7 = misc.chop(ticketname, 7)
         msg = "%s added ticket '%s'" % (i.issuer, sha7)
         msg = msg.capitalize()
-        abs_ticket_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR)
+        try:
+            self.commit_changes({i.path(self.load_index().layout): i.contents()}, msg)
+            print("New ticket '%s' saved" % sha7)
+        except Exception as e:
+            log.printerr("Error commiting changes to ticket '%s': %s" % (sha7, e))
+            sys.exit(1)
+        return i
+
 
+    def import_tickets(self, filename, format, chunk = None):
+        """ Adds the tickets of the records in `filename` (or stdin for '-')
+            in 'jsonl', 'csv' or 'tsv' format (see itimport), in one commit
+            or in commits of `chunk` tickets.
+
+            The records are streamed into 'git fast-import' as they are read,
+            and the itdb branch is advanced once, after the last one. If any
+            record is invalid, nothing is imported at all.
+        """
+        import itimport
+        self.require_itdb()
+        index = self.load_index()
+        fullname = self.get_cfg('name', section='user', default='Anonymous')
+        email = self.get_cfg('email', section='user', default='')
+        # the ticket files are utf-8, like the records
+        issuer = (u'%s <%s>' % (fullname, email)).encode('utf-8')
+        user = getpass.getuser()
+
+        try:
+            f = filename == '-' and sys.stdin or open(filename, 'rb')
+        except IOError as e:
+            log.printerr("Cannot read '%s': %s" % (filename, e.strerror))
+            sys.exit(1)
+
+        ref = 'refs/it/import-%d' % os.getpid()
+        stream = itimport.FastImport(self.repo, ref, index.commit, index.layout,
+                                     index.packs, self.read_pack)
+        errors = []
+        ids = set()
+        count = 0
+        def message(first, last):
+            if first == last:
+                return "%s imported ticket %d" % (issuer, first)
+            return "%s imported tickets %d-%d" % (issuer, first, last)
         try:
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+it.ITDB_BRANCH])
-            self.repo.git.add([i.filename()])
-            self.repo.git.commit(['-m', msg, i.filename()])
-        except:
-            log.printerr("Error commiting changes to ticket '%s'" % sha7)
+            for lineno, record in itimport.read_records(f, format, errors):
+                try:
+                    with timing.phase('parse'):
+                        i = itimport.create_ticket(record, issuer)
+                except itimport.ImportException as e:
+                    errors.append("line %d: %s" % (lineno, e))
+                    continue
+                if i.id is None:
+                    while i.id is None or i.id in ids or i.id in index.tickets:
+                        i.id = new_ticket_id(i, user)
+                elif i.id in ids or i.id in index.tickets:
+                    errors.append("line %d: Ticket '%s' already exists" % (lineno, i.id))
+                    continue
+                ids.add(i.id)
+                if errors:
+                    # only check the remaining records
+                    continue
+                stream.add(i)
+                count += 1
+                if chunk and len(stream) == chunk:
+                    stream.commit(message(count - chunk + 1, count))
+            if not errors and len(stream):
+                stream.commit(stream.commits and message(count - len(stream) + 1, count)
+                        or "%s imported %d tickets" % (issuer, count))
+            with timing.phase('commit'):
+                commit = stream.finish()
+        except Exception as e:
+            log.printerr("Error importing tickets: %s" % e)
+            log.printerr("No tickets imported.")
+            sys.exit(1)
         finally:
-            os.remove(i.filename())
-            self.repo.git.rm(['--cached', i.filename()])
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+curr_branch])
-            self.repo.git.reset(['HEAD', '--', abs_ticket_dir])
-            misc.rmdirs(abs_ticket_dir)
-        return i
+            if f is not sys.stdin:
+                f.close()
+
+        if errors:
+            for error in errors:
+                log.printerr(error)
+            log.printerr("No tickets imported.")
+            sys.exit(1)
+        if commit is None:
+            print("Nothing to import.")
+            return
+
+        msg = "%s imported %d tickets" % (issuer, count)
+        try:
+            itdb.update_branch(self.repo, self.repo.commit(commit), msg, index.commit)
+        except Exception as e:
+            log.printerr("Error importing tickets: %s" % e)
+            log.printerr("No tickets imported.")
+            sys.exit(1)
+        self._base = commit
+        print("Imported %d tickets in %d commit%s" % (count, stream.commits,
+                stream.commits != 1 and 's' or ''))
 
 
     def progress_bar(self, percentage_done, width = 32):
@@ -407,38 +827,59 @@ class Gitit:
                      int(percentage_done * 100)
 
 
-    def __print_ticket_rows(self, rel, tickets, show_types, show_progress_bar, annotate_ownership):
+    def __print_ticket_rows(self, table, rel, rows, show_types, show_progress_bar,
+            annotate_ownership, order = DEFAULT_ORDER, limit = None, offset = 0,
+            match = None):
+        """ Prints the tickets in `rows` of the ticket table `table` for
+            release `rel` that have a status of `show_types` and satisfy the
+            query predicate `match`, sorted by `order`. Only the page of
+            `limit` tickets after the first `offset` ones is read and rendered.
+        """
         print_count = 0
 
         # Get the available terminal drawing space
-        try:
-            width, _ = os.get_terminal_size()
-        except Exception:
-            _, width = os.popen('stty size').read().strip().split()
-            width = int(width)
-
-        total = sum([t.weight for t in tickets if t.status != 'rejected']) * 1.0
-        done = sum([t.weight for t in tickets if t.status not in ['open', 'rejected', 'test']]) * 1.0
+        width = self.term_width
+        if width is None:
+            try:
+                width, _ = os.get_terminal_size()
+            except Exception:
+                try:
+                    _, width = os.popen('stty size 2>/dev/null').read().strip().split()
+                    width = int(width)
+                except ValueError:
+                    # not on a terminal
+                    width = int(os.environ.get('COLUMNS', 80))
+
+        # The progress and the filter only need the columns of the table
+        total, done = table.progress(rows)
         release_line = colors.colors['red-on-white'] + '%-16s' % rel + \
                                                                                                          colors.colors['default']
 
         # Show a progress bar only when there are items in this release
         if total > 0 and show_progress_bar:
-            header = release_line + self.progress_bar(done / total)
+            header = release_line + self.progress_bar(done * 1.0 / total)
         else:
             header = release_line
 
-        # First, filter all types that do not need to be shown out of the list
-        tickets_to_print = filter(lambda t: t.status in show_types, tickets)
+        # First, filter all types that do not need to be shown out of the list,
+        # then pick the requested page of them in the requested order
+        rows = table.where(rows, 'status', show_types)
+        if match is not None:
+            rows = matching_rows(table.headers, rows, match)
+        with timing.phase('sort'):
+            rows = table.page(rows, order, limit, offset)
+        tickets_to_print = [table.headers.ticket(row) for row in rows]
         if len(tickets_to_print) > 0:
             print(header)
 
-            # Then, sort the tickets by date modified
-            tickets_to_print.sort(cmp_by_prio_then_date)
+            # Show the shortest ids that are still unique, but no shorter
+            # than the configured abbreviation length
+            id_width = max([int(self._gitcfg.get_value('it', 'abbrev', 7))] + \
+                    [table.headers.unique_prefix_length(row) for row in rows])
 
             # ...and finally, print them
             hide_status = show_types == [ 'open' ]
-            cols = [ { 'id': 'id',     'width':  7, 'visible': True },
+            cols = [ { 'id': 'id',     'width': id_width, 'visible': True },
                      { 'id': 'type',   'width':  7, 'visible': True },
                      { 'id': 'title',  'width':  0, 'visible': True },
                      { 'id': 'wght',   'width':  5, 'visible': not hide_status },
@@ -466,9 +907,10 @@ class Gitit:
                     + colors.colors['default']
             )
 
-            for t in tickets_to_print:
-                print_count += 1
-                print(t.oneline(cols, annotate_ownership))
+            with timing.phase('render'):
+                for t in tickets_to_print:
+                    print_count += 1
+                    print(t.oneline(cols, annotate_ownership))
 
             print('')
         else:
@@ -477,54 +919,133 @@ class Gitit:
         return print_count
 
 
-    def list(self, show_types = ['open', 'test'], releases_filter = []):
+    def list(self, show_types = ['open', 'test'], releases_filter = [], jobs = 1,
+             order = None, limit = None, offset = 0, where = None):
+        """ Prints the tickets with a status of `show_types` that match the
+            query `where` (see the query module) per release, in `order` (see
+            ittable.TicketTable.sort) or by priority and date. With a `limit`,
+            only that many tickets after the first `offset` ones are shown per
+            release.
+        """
+        import query, parallel
+        order = order or DEFAULT_ORDER
+        # build the index with all jobs before require_itdb() needs it
+        table = self.load_table(jobs)
         self.require_itdb()
-        base_tree = self.repo.heads[it.ITDB_BRANCH].commit.tree[it.TICKET_DIR]
-        releasedirs = [(x.mode, x.type, x.hexsha, x.name) for x in base_tree.trees]
+        releases = table.group_by('release')
+        releasedirs = releases.keys()
 
         # Filter releases
         if releases_filter:
-            filtered = []
-            for dir in releasedirs:
-                _, _, _, name = dir
-                if name in releases_filter:
-                    filtered.append(dir)
-            releasedirs = filtered
+            releasedirs = [rel for rel in releasedirs if rel in releases_filter]
 
         # Show message if no tickets there
         if len(releasedirs) == 0:
             print("No tickets yet. Use 'it new' to add new tickets.")
             return
 
-        # Collect tickets assigned to self on the way
-        inbox = []
+        with timing.phase('sort'):
+            releasedirs.sort(cmp_by_release)
+        fullname = self.get_cfg('name', section='user', default='Anonymous')
+        match = where and query.compile(query.parse(where), fullname) or None
 
+        def list_release(rel):
+            print_count = self.__print_ticket_rows(table, rel, releases[rel],
+                    show_types, True, True, order, limit, offset, match)
+
+            # Collect tickets assigned to self on the way
+            return print_count, table.where(releases[rel], 'assignee', [fullname])
+
+        # With jobs > 1, releases are rendered in parallel, but printed in order
         print_count = 0
-        releasedirs.sort(cmp_by_release_dir)
-        fullname = self.get_cfg('name', section='user', default='Anonymous')
-        for _, _, sha, rel in releasedirs:
-            rel_tree = self.repo.heads[it.ITDB_BRANCH].commit.tree[it.TICKET_DIR]
-            for dir in rel.split('/'):
-                rel_tree = rel_tree[dir]
-            ticketfiles = [(x.mode, x.type, x.hexsha, x.name) for x in rel_tree.blobs]
+        inbox = []
+        for count, mine in parallel.map_output(list_release, releasedirs, jobs):
+            print_count += count
+            inbox += mine
+
+        print_count += self.__print_ticket_rows(table, 'INBOX', inbox,
+                (show_types == ['open','test']) and ['open'] or show_types, False, False,
+                order, limit, offset, match)
+
+        if print_count == 0 and where:
+            print("No tickets match the query")
+        elif print_count == 0:
+            print("Use the -a flag to show all tickets")
 
-            tickets = [ ticket.create_from_lines(\
-                        self.repo.git.cat_file(['-p', sha]).split("\n"), \
-                        ticket_id, rel, True) \
-                    for _, type, sha, ticket_id in ticketfiles \
-                    if type == 'blob' and ticket_id != it.HOLD_FILE \
-            ]
 
+    def list_records(self, format, show_types = ['open', 'test'], releases_filter = [], jobs = 1,
+                     order = None, limit = None, offset = 0, where = None):
+        """ Writes one machine-readable record per ticket, in 'jsonl' or 'tsv'
+            format. Records are written as the tickets are read, without
+            colors, sorting or terminal probing, so the output can be piped
+            straight into other tools. With `jobs` > 1, ranges of ticket ids
+            are formatted in parallel and written in order. With an `order` or
+            a `limit`, the page of the matching tickets in that order (or in
+            id order) is written instead. Only the tickets that match the
+            query `where` are read.
+        """
+        import json, query, parallel
+        from collections import OrderedDict
+        headers = self.load_headers(jobs)
+        self.require_itdb()
+        fullname = self.get_cfg('name', section='user', default='Anonymous')
+        match = where and query.compile(query.parse(where), fullname) or None
+
+        fields = ticket.Ticket.record_fields
+        if format == 'tsv':
+            sys.stdout.write('\t'.join(fields) + '\n')
+
+        def write_records(rows):
+            for row in rows:
+                t = headers.ticket(row)
+
+                with timing.phase('render'):
+                    values = t.record()
+                    if format == 'jsonl':
+                        line = json.dumps(OrderedDict(zip(fields, values)))
+                    else:
+                        line = '\t'.join([re.sub(r'[\t\r\n]', ' ', '%s' % v) for v in values])
+                    sys.stdout.write(line + '\n')
+
+        if order is None and limit is None:
+            # Stream the records in id order, one at a time
+            count = len(headers)
+            parts = max(1, min(jobs * 4, count))
+            spans = [xrange(n * count // parts, (n + 1) * count // parts) for n in range(parts)]
+            parallel.map_output(lambda span: write_records(
+                    headers.select(span, show_types, releases_filter, match)), spans, jobs)
+            return
 
-            # Store the tickets in the inbox if neccessary
-            inbox += filter(lambda t: t.is_mine(fullname), tickets)
+        # Select the tickets on the columns of the table before reading any
+        table = self.load_table(jobs)
+        rows = table.where(table.rows(), 'status', show_types)
+        if releases_filter:
+            rows = table.where(rows, 'release', releases_filter)
+        if match is not None:
+            rows = matching_rows(headers, rows, match)
+        with timing.phase('sort'):
+            rows = table.page(rows, order or [], limit, offset)
+        parallel.map_output(write_records, parallel.shards(rows, jobs * 4), jobs)
 
-            print_count += self.__print_ticket_rows(rel, tickets, show_types, True, True)
 
-        print_count += self.__print_ticket_rows('INBOX', inbox, (show_types == ['open','test']) and ['open'] or show_types, False, False)
+    def search(self, *words):
+        """ Lists the tickets containing all of `words` in their subject,
+            issuer or body, best match first.
+        """
+        self.require_itdb()
+        index = self.load_index()
+        results = self.load_search_index().search(words)
+        if not results:
+            print("No tickets match '%s'" % ' '.join(words))
+            return
 
-        if print_count == 0:
-            print("Use the -a flag to show all tickets")
+        id_width = max([int(self._gitcfg.get_value('it', 'abbrev', 7))] + \
+                [index.unique_prefix_length(id) for _, id in results])
+        for _, id in results:
+            t = index.ticket(id)
+            with timing.phase('render'):
+                print('%s %-8s %-16s %s' % (id[:id_width],
+                        t.status, t.release, t.title))
 
 
     def rm(self, sha):
@@ -540,36 +1061,25 @@ class Gitit:
         _, basename = os.path.split(match)
         sha7 = misc.chop(basename, 7)
 
-        # prepare the critical section
-        curr_branch = self.repo.active_branch.name
-        curr_dir = os.getcwd()
+        # Commit the removal to the itdb branch
         msg = "Removed ticket '%s'" % sha7
-        abs_ticket_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR)
-
-        # Commit the new itdb to the repo
         try:
-            os.chdir(self.repo.working_dir)
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+it.ITDB_BRANCH])
-            self.repo.git.commit(['-m', msg, match])
+            self.commit_changes({match: None}, msg)
             print("ticket '%s' removed" % sha7)
-        except Exception:
-            log.printerr("Error commiting change!")
+        except Exception as e:
+            log.printerr("Error commiting change: %s" % e)
             sys.exit(1)
-        finally:
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+curr_branch])
-            self.repo.git.reset(['HEAD', '--', abs_ticket_dir])
-            misc.rmdirs(abs_ticket_dir)
-            os.chdir(curr_dir)
 
 
     def get_ticket(self, sha):
         match = self.match_or_error(sha)
-        parent, fullsha = os.path.split(match)
-        rel = os.path.basename(parent)
+        fullsha = os.path.basename(match)
 
-        contents = self.repo.git.cat_file(['-p', it.ITDB_BRANCH + ':' + match])
-        i = ticket.create_from_lines(contents.split("\n"), fullsha, rel, True)
-        return (i, rel, fullsha, match)
+        # The header comes from the header cache, the body is only read when needed
+        headers = self.load_headers()
+        row = headers.match(fullsha)[0]
+        i = headers.ticket(row, self.body_loader(*headers.location(row)))
+        return (i, headers.release(row), fullsha, match)
 
 
     def finish_ticket(self, sha, new_status):
@@ -579,28 +1089,15 @@ class Gitit:
             log.printerr("Ticket '%s' already %s" % (sha7, i.status))
             sys.exit(1)
 
-        # Now, when the edit has succesfully taken place, switch branches, commit,
-        # and switch back
-        curr_branch = self.repo.active_branch.name
-        curr_dir = os.getcwd()
-        msg = "%s ticket '%s'" % (i.status, sha7)
+        msg = "%s ticket '%s'" % (new_status, sha7)
         msg = msg.capitalize()
-        abs_ticket_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR)
-
         try:
-            os.chdir(self.repo.working_dir)
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+it.ITDB_BRANCH])
             i.status = new_status
-            i.save()
-            self.repo.git.commit(['-m', msg, match])
+            self.commit_changes({match: i.contents()}, msg)
             print("Ticket '%s' now %s" % (sha7, new_status))
-        except Exception:
-            log.printerr("Error commiting changes to ticket '%s'" % sha7)
-        finally:
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+curr_branch])
-            self.repo.git.reset(['HEAD', '--', abs_ticket_dir])
-            misc.rmdirs(abs_ticket_dir)
-            os.chdir(curr_dir)
+        except Exception as e:
+            log.printerr("Error commiting changes to ticket '%s': %s" % (sha7, e))
+            sys.exit(1)
 
 
     def reopen_ticket(self, sha):
@@ -610,26 +1107,14 @@ class Gitit:
             log.printerr("Ticket '%s' already open" % sha7)
             sys.exit(1)
 
-        # Now, when the edit has succesfully taken place, switch branches, commit,
-        # and switch back
-        curr_branch = self.repo.active_branch.name
-        curr_dir = os.getcwd()
         msg = "Ticket '%s' reopened" % sha7
-        abs_ticket_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR)
-
         try:
-            os.chdir(self.repo.working_dir)
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+it.ITDB_BRANCH])
             i.status = 'open'
-            i.save()
-            self.repo.git.commit(['-m', msg, match])
+            self.commit_changes({match: i.contents()}, msg)
             print(msg)
-
-        finally:
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+curr_branch])
-            self.repo.git.reset(['HEAD', '--', abs_ticket_dir])
-            misc.rmdirs(abs_ticket_dir)
-            os.chdir(curr_dir)
+        except Exception as e:
+            log.printerr("Error commiting changes to ticket '%s': %s" % (sha7, e))
+            sys.exit(1)
 
 
     def take_ticket(self, sha):
@@ -641,26 +1126,13 @@ class Gitit:
             return
 
         msg = "Ticket '%s' taken by '%s'" % (sha7, fullname)
-        abs_ticket_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR)
-
-        # prepare for critical section
-        curr_branch = self.repo.active_branch.name
-        curr_dir = os.getcwd()
-
         try:
-            os.chdir(self.repo.working_dir)
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+it.ITDB_BRANCH])
             i.assigned_to = fullname
-            i.save()
-            self.repo.git.commit(['-m', msg, '--', match])
+            self.commit_changes({match: i.contents()}, msg)
             print(msg)
-        except Exception:
-            print("Error commiting change -- cleanup")
-        finally:
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+curr_branch])
-            self.repo.git.reset(['HEAD', '--', abs_ticket_dir])
-            misc.rmdirs(abs_ticket_dir)
-            os.chdir(curr_dir)
+        except Exception as e:
+            log.printerr("Error commiting changes to ticket '%s': %s" % (sha7, e))
+            sys.exit(1)
 
 
     def leave_ticket(self, sha):
@@ -672,25 +1144,184 @@ class Gitit:
             print("Ticket '%s' already left alone" % (sha7))
             return
 
-        # prepare for the critical section
-        curr_branch = self.repo.active_branch.name
-        curr_dir = os.getcwd()
         msg = "Ticket %s was left alone from '%s'" % (sha7, fullname)
-        abs_ticket_dir = os.path.join(self.repo.working_dir, it.TICKET_DIR)
-
         try:
-            os.chdir(self.repo.working_dir)
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+it.ITDB_BRANCH])
             i.assigned_to = '-'
-            i.save()
-            self.repo.git.commit(['-m', msg, match])
+            self.commit_changes({match: i.contents()}, msg)
             print(msg)
-        except Exception:
-            print("Error commiting change -- cleanup")
-        finally:
-            self.repo.git.symbolic_ref(['HEAD', 'refs/heads/'+curr_branch])
-            self.repo.git.reset(['HEAD', '--', abs_ticket_dir])
-            misc.rmdirs(abs_ticket_dir)
-            os.chdir(curr_dir)
+        except Exception as e:
+            log.printerr("Error commiting changes to ticket '%s': %s" % (sha7, e))
+            sys.exit(1)
+
+
+    def migrate(self, layout):
+        """ Moves all tickets to the 'fanout', 'flat' or 'packed' storage
+            layout in a single commit. Tickets that are not moved into or out
+            of a pack keep their blobs.
+        """
+        self.require_itdb()
+        # other writers wait until the tickets are moved, so none of their
+        # changes are left behind in the old layout
+        with itdb.commit_lock(self.repo):
+            index = self.load_index()
+
+            changes = {}
+            packs = {}
+            moved = 0
+            for id in index.ids:
+                release, blob, _, old_layout, span = index.tickets[id]
+                if old_layout == layout:
+                    continue
+                moved += 1
+                if span is None:
+                    changes[index.path(id)] = None
+                    contents = itdb.StoredBlob(blob)
+                    if layout == it.PACKED_LAYOUT:
+                        contents = self.read_blob(blob)
+                else:
+                    changes[itpack.pack_path(release)] = None
+                    contents = self.read_packed(blob, span)
+                if layout == it.PACKED_LAYOUT:
+                    packs.setdefault(release, {})[id] = contents
+                else:
+                    changes[ticket.ticket_path(release, id, layout)] = contents
+            for release, records in packs.items():
+                changes[itpack.pack_path(release)] = itpack.build(records)
+            if index.layout != layout:
+                layout_file = os.path.join(it.TICKET_DIR, it.LAYOUT_FILE)
+                changes[layout_file] = layout != it.FLAT_LAYOUT and layout + '\n' or None
+            if not changes:
+                print("Ticket database already uses the %s layout." % layout)
+                return
+
+            msg = "Migrated ticket database to the %s layout\n\nMoved %d tickets." \
+                    % (layout, moved)
+            try:
+                self.__commit(changes, msg, index.commit)
+            except Exception as e:
+                log.printerr("Error commiting migration: %s" % e)
+                sys.exit(1)
+        print("Moved %d tickets to the %s layout" % (moved, layout))
+
+
+    def serve(self):
+        """ Runs the 'it serve' daemon for this repository.
+        """
+        import server
+        server.serve(self)
+
+
+    def batch(self, lines):
+        """ Applies ticket operations, one per line, in a single commit.
+
+            All operations are validated against one snapshot of the itdb,
+            including the effect of the operations before them. If any of
+            them is invalid, nothing is committed at all.
+        """
+        self.require_itdb()
+        index = self.load_index()
+        fullname = self.get_cfg('name', section='user', default='Anonymous')
+
+        tickets = {}    # id -> ticket as changed by the batch so far
+        removed = set()
+        messages = []
+        errors = []
+        for lineno, line in enumerate(lines):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            op, args = words[0], words[1:]
+            if op == 'rm' and args[:1] == ['-f']:
+                del args[0]
+
+            try:
+                if op not in BATCH_OPERATIONS:
+                    raise BatchOperationException("Unknown operation '%s'" % op)
+                if len(args) != 1 + len(BATCH_OPERATIONS[op]):
+                    raise BatchOperationException("Usage: %s <id> %s" \
+                            % (op, ' '.join(BATCH_OPERATIONS[op])))
+
+                matches = [id for id in index.match(args[0]) if id not in removed]
+                if len(matches) == 0:
+                    raise BatchOperationException("No such ticket '%s'" % args[0])
+                elif len(matches) > 1:
+                    raise BatchOperationException("Ambiguous ticket id '%s'" % args[0])
+                id = matches[0]
+                if id not in tickets:
+                    tickets[id] = index.ticket(id, self.body_loader(*index.location(id)))
+
+                msg = self.__apply_batch_operation(tickets[id], op, args[1:], fullname)
+                if op == 'rm':
+                    removed.add(id)
+                if msg:
+                    messages.append(msg)
+            except BatchOperationException as e:
+                errors.append("line %d: %s" % (lineno + 1, e))
+
+        if errors:
+            for error in errors:
+                log.printerr(error)
+            log.printerr("No changes committed.")
+            sys.exit(1)
+        if not messages:
+            print("Nothing to do.")
+            return
+
+        # Collect the new contents of all affected tickets
+        changes = {}
+        for id, i in tickets.items():
+            path = index.path(id)
+            if id in removed or i.path(index.layout) != path:
+                changes[path] = None
+            if id not in removed:
+                changes[i.path(index.layout)] = i.contents()
+
+        msg = "Batch of %d ticket operations\n\n%s" \
+                % (len(messages), '\n'.join(messages))
+        try:
+            self.commit_changes(changes, msg)
+        except Exception as e:
+            log.printerr("Error commiting batch: %s" % e)
+            sys.exit(1)
+        for line in messages:
+            print(line)
+        print("%d ticket operations committed" % len(messages))
+
+
+    def __apply_batch_operation(self, i, op, args, fullname):
+        """ Applies a single batch operation to ticket `i` and returns the
+            message describing it, or None if there was nothing to change.
+            Follows the rules of the corresponding single subcommands.
+        """
+        sha7 = misc.chop(i.id, 7)
+        if op in FINISH_STATUS:
+            if i.status not in ['open', 'test']:
+                raise BatchOperationException("Ticket '%s' already %s" % (sha7, i.status))
+            i.status = FINISH_STATUS[op]
+            return ("%s ticket '%s'" % (i.status, sha7)).capitalize()
+        elif op == 'reopen':
+            if i.status == 'open':
+                raise BatchOperationException("Ticket '%s' already open" % sha7)
+            i.status = 'open'
+            return "Ticket '%s' reopened" % sha7
+        elif op == 'take':
+            if i.assigned_to == fullname:
+                return None
+            i.assigned_to = fullname
+            return "Ticket '%s' taken by '%s'" % (sha7, fullname)
+        elif op == 'leave':
+            if i.assigned_to == '-':
+                return None
+            i.assigned_to = '-'
+            return "Ticket %s was left alone from '%s'" % (sha7, fullname)
+        elif op == 'mv':
+            to_rel = args[0]
+            if i.release == to_rel:
+                return None
+            msg = "Moved ticket '%s' (%s --> %s)" % (sha7, i.release, to_rel)
+            i.release = to_rel
+            return msg
+        elif op == 'rm':
+            return "Removed ticket '%s'" % sha7
 
 #EOF
@@ -7,7 +7,37 @@ ITDB_BRANCH    = 'git-it'
 TICKET_DIR     = 'tickets'
 HOLD_FILE      = '.hold'
 
+# names the storage layout of a database, if it is not the flat layout of
+# tickets/<release>/<id>: 'fanout' stores tickets as tickets/<release>/<xx>/<id>,
+# where <xx> are the first two characters of the id, and 'packed' stores all
+# tickets of a release in tickets/<release>/.pack (see itpack)
+LAYOUT_FILE    = '.layout'
+FLAT_LAYOUT    = 'flat'
+FANOUT_LAYOUT  = 'fanout'
+PACKED_LAYOUT  = 'packed'
+LAYOUTS        = [ FLAT_LAYOUT, FANOUT_LAYOUT, PACKED_LAYOUT ]
+PACK_FILE      = '.pack'
+
 # release/category string used for not categorized issues
 UNCATEGORIZED  = 'None'
 
-EDIT_TMP_FILE  = '.it-edit.tmp'
+# ticket index cache, relative to the .git directory
+INDEX_FILE     = 'it-index'
+
+# memory-mapped ticket header cache, relative to the .git directory
+HEADERS_FILE   = 'it-headers'
+
+# full-text search index, relative to the .git directory
+SEARCH_FILE    = 'it-search'
+
+# ticket history cache of 'it log', relative to the .git directory
+LOG_FILE       = 'it-log'
+
+# release statistics of 'it stats', relative to the .git directory
+STATS_FILE     = 'it-stats'
+
+# socket of the 'it serve' daemon, relative to the .git directory
+SOCKET_FILE    = 'it.sock'
+
+# lock file writers take turns on, relative to the .git directory
+COMMIT_LOCK_FILE = 'it-commit.lock'
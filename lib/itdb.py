@@ -0,0 +1,190 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Low-level write access to the ticket database.
+#
+# Blobs and trees are built in memory and stored straight into the object
+# database, which mirrors 'git hash-object -w' and 'git mktree'. Commits are
+# made with 'git commit-tree'. The branch is then advanced with 'git
+# update-ref', which checks that it still points to the commit the new one
+# was built on, so concurrent writers never overwrite each other's commits.
+# Neither HEAD, the index nor the working tree are ever touched. Writers
+# also take turns on a lock, so they do not keep redoing their commits.
+#
+import os
+import errno
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from io import BytesIO
+from binascii import hexlify, unhexlify
+import it
+
+from gitdb import IStream
+from git import Actor, Tree, GitCommandError
+from git.objects.fun import tree_to_stream
+
+BLOB_MODE = 0o100644
+TREE_MODE = 0o040000
+
+# the old value of 'git update-ref' for a branch that must not exist yet
+NULL_SHA = '0' * 40
+
+
+class BranchMovedException(Exception): pass
+
+
+class StoredBlob(object):
+    """ Refers to a blob that is already in the object database, to put it
+        at another path without reading and writing its contents again.
+    """
+    __slots__ = ('binsha',)
+
+    def __init__(self, hexsha):
+        self.binsha = unhexlify(hexsha)
+
+
+def store_object(repo, type, data):
+    """ Stores `data` as an object of the given type and returns its binary SHA.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    sha = hashlib.sha1(b'%s %d\0' % (type, len(data)) + data)
+    path = repo.odb.db_path(repo.odb.object_path(sha.hexdigest()))
+    if os.path.isfile(path):
+        return sha.digest()
+    # The object database creates the directory of an object without
+    # expecting another process to create it at the same time
+    try:
+        os.mkdir(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    istream = repo.odb.store(IStream(type, len(data), BytesIO(data)))
+    return istream.binsha
+
+
+def write_tree(repo, tree, changes):
+    """ Writes a copy of `tree` (a Tree object or None) with `changes` applied
+        and returns the binary SHA of the new tree.
+
+        `changes` maps paths relative to `tree` to the new contents of the
+        blob at that path, to a StoredBlob, or to None to remove the path.
+        Subtrees that end up empty are dropped, like git does. Returns None
+        if the resulting tree is empty.
+    """
+    entries = {}
+    if tree is not None:
+        for obj in tree:
+            # the paths of `changes` are utf-8 byte strings, like git's
+            name = obj.name
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            entries[name] = (obj.binsha, obj.mode, name)
+
+    # Split the changes in those for this level and those for the subtrees
+    subchanges = {}
+    for path, contents in changes.items():
+        name, _, rest = path.partition('/')
+        if rest:
+            subchanges.setdefault(name, {})[rest] = contents
+        elif contents is None:
+            entries.pop(name, None)
+        elif isinstance(contents, StoredBlob):
+            entries[name] = (contents.binsha, BLOB_MODE, name)
+        else:
+            entries[name] = (store_object(repo, 'blob', contents), BLOB_MODE, name)
+
+    for name, sub in subchanges.items():
+        subtree = None
+        if name in entries and entries[name][1] == TREE_MODE:
+            subtree = Tree(repo, entries[name][0], TREE_MODE, name.decode('utf-8'))
+        binsha = write_tree(repo, subtree, sub)
+        if binsha is None:
+            entries.pop(name, None)
+        else:
+            entries[name] = (binsha, TREE_MODE, name)
+
+    if not entries:
+        return None
+
+    # git sorts tree entries as if subtree names ended with a slash
+    sorted_entries = sorted(entries.values(),
+            key=lambda e: e[1] == TREE_MODE and e[2] + '/' or e[2])
+    stream = BytesIO()
+    tree_to_stream(sorted_entries, stream.write)
+    return store_object(repo, 'tree', stream.getvalue())
+
+
+def create_commit(repo, parent, changes, msg, merge=None):
+    """ Creates a commit that applies `changes` (see write_tree) on top of the
+        commit `parent`, or a root commit if `parent` is None. The commit
+        `merge`, if given, becomes a second parent. The new commit is not
+        referenced by any branch yet.
+    """
+    if parent is None:
+        base_tree, parents = None, []
+    else:
+        base_tree, parents = parent.tree, [parent]
+    if merge is not None:
+        parents.append(merge)
+
+    tree_sha = write_tree(repo, base_tree, changes)
+    if tree_sha is None:
+        tree_sha = store_object(repo, 'tree', b'')
+
+    # 'git commit-tree' writes the commit safely next to other processes;
+    # the identities are GitPython's, which does without a configured email
+    config = repo.config_reader()
+    env = {}
+    for role, actor in [('AUTHOR', Actor.author(config)), ('COMMITTER', Actor.committer(config))]:
+        for part, value in [('NAME', actor.name), ('EMAIL', actor.email)]:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            env['GIT_%s_%s' % (role, part)] = value
+    args = [hexlify(tree_sha), '-m', msg]
+    for commit in parents:
+        args += ['-p', commit.hexsha]
+    return repo.commit(repo.git.commit_tree(args, env=env))
+
+
+@contextmanager
+def commit_lock(repo):
+    """ Waits until no other process that commits to the itdb branch of
+        `repo` holds the lock, and holds it until the block is left. The lock
+        is released when the process ends as well, so it cannot be left
+        behind. It only saves work; update_branch still refuses to overwrite
+        the commits of processes that do not take it.
+    """
+    f = open(os.path.join(repo.git_dir, it.COMMIT_LOCK_FILE), 'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+    finally:
+        f.close()
+
+
+def branch_commit(repo, branch=it.ITDB_BRANCH):
+    """ Returns the hex SHA of the commit `branch` points to, or None.
+    """
+    try:
+        return repo.git.rev_parse(['--verify', '--quiet', 'refs/heads/' + branch])
+    except GitCommandError:
+        return None
+
+
+def update_branch(repo, commit, msg, old, branch=it.ITDB_BRANCH):
+    """ Points `branch` to `commit` with a single 'git update-ref' call, if
+        it still points to the commit `old` (a hex SHA), or does not exist
+        if `old` is None. The first line of `msg` is used for the reflog.
+        Raises a BranchMovedException if another process moved the branch.
+    """
+    ref = 'refs/heads/' + branch
+    try:
+        repo.git.update_ref(['-m', msg.split('\n')[0], ref, commit.hexsha,
+                old or NULL_SHA])
+    except GitCommandError:
+        if branch_commit(repo, branch) != old:
+            raise BranchMovedException("'%s' was changed by another process" % branch)
+        raise
+
+#EOF
@@ -0,0 +1,304 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Memory-mapped cache of the ticket headers, for commands that only read.
+#
+# The cache is derived from the ticket index (see itindex) and stored under
+# the .git directory as a binary file: a header with the itdb branch commit
+# it was built from, one fixed-width record per ticket, sorted by id, and a
+# table of the distinct strings the records point into. The file is opened
+# with mmap, so looking up an id is a binary search over the records and
+# only touches the pages it reads, and listing the tickets decodes the
+# records without unpickling the index. When the branch has moved, the cache
+# is rebuilt from the updated index.
+#
+import os
+import mmap
+import struct
+import ticket, timing
+
+# Bump whenever the layout of the file changes
+HEADERS_VERSION = 3
+
+MAGIC = 'ITHC'
+
+# magic, version, hold file present, commit, number of records
+FILE_HEADER = struct.Struct('<4sHH40sI')
+
+# id, blob, pack span offset and length, priority, weight, date sort key and
+# the string table offsets of the release, layout, status, type, assignee,
+# issuer, title, date, priority and weight. The sort key of a date is the
+# number made of its digits, which orders like the date itself. The numeric
+# priority and weight are what lists and reports sort and sum; the strings
+# are what the ticket says, as hand-edited tickets may hold any value.
+RECORD = struct.Struct('<40s40sIIiid10I')
+
+# the range of the numeric priority and weight fields of a record
+NUMBER_MIN, NUMBER_MAX = -0x80000000, 0x7fffffff
+
+# numeric priority and weight of the tickets that lack them, or hold no
+# number, like a new ticket.Ticket has
+NUMBER_DEFAULTS = { 'Priority': 3, 'Weight': 3 }
+
+# the string table offset of a field a ticket lacks
+MISSING = 0xffffffff
+
+# string fields of a record -> their header fields; release and layout are
+# not header fields
+STRING_FIELDS = [ 'release', 'layout', 'status', 'type', 'assignee', 'issuer',
+                  'title', 'date', 'prio_text', 'weight_text' ]
+HEADER_FIELDS = { 'status': 'Status', 'type': 'Type', 'assignee': 'Assigned to',
+                  'issuer': 'Issuer', 'title': 'Subject', 'date': 'Date',
+                  'prio_text': 'Priority', 'weight_text': 'Weight' }
+
+# record field -> position in an unpacked record
+POSITIONS = dict([(name, n) for n, name in enumerate(
+        [ 'id', 'blob', 'offset', 'length', 'prio', 'weight', 'date_key' ] + STRING_FIELDS)])
+
+STRING_LENGTH = struct.Struct('<I')
+
+
+def date_key(date):
+    digits = ''.join([c for c in date if c.isdigit()])
+    return digits and float(digits) or 0.0
+
+
+def number(value, default):
+    """ Returns the priority or weight `value` of a ticket as a number,
+        clamped to the range of the record fields, or `default` if the
+        ticket lacks it or it is not a number.
+    """
+    try:
+        return max(NUMBER_MIN, min(int(value), NUMBER_MAX))
+    except (TypeError, ValueError):
+        return default
+
+
+def build(index):
+    """ Returns the contents of the header cache of the ticket `index`.
+    """
+    strings = {}
+    table = []
+    size = [0]
+    def string(value):
+        if value is None:
+            return MISSING
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        offset = strings.get(value)
+        if offset is None:
+            offset = strings[value] = size[0]
+            table.append(STRING_LENGTH.pack(len(value)) + value)
+            size[0] += STRING_LENGTH.size + len(value)
+        return offset
+
+    records = []
+    for id in index.ids:
+        release, blob, fields, layout, span = index.tickets[id]
+        offset, length = span or (0, 0)
+        records.append(RECORD.pack(str(id), str(blob), offset, length,
+                number(fields.get('Priority'), NUMBER_DEFAULTS['Priority']),
+                number(fields.get('Weight'), NUMBER_DEFAULTS['Weight']),
+                date_key(fields.get('Date', '')), string(release), string(layout),
+                *[string(fields.get(HEADER_FIELDS[name])) for name in STRING_FIELDS[2:]]))
+    header = FILE_HEADER.pack(MAGIC, HEADERS_VERSION, index.hold and 1 or 0,
+                              str(index.commit), len(records))
+    return ''.join([header] + records + table)
+
+
+class HeaderCache(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.commit = None
+        self.hold = False
+        self.count = 0
+        self.data = ''
+        self.strings = 0
+
+    def open(self, commit):
+        """ Maps the cache file into memory. Returns False, leaving the cache
+            empty, if it is missing, unreadable or was not built from
+            `commit` (a hex SHA).
+        """
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        except (EnvironmentError, ValueError):
+            # mmap refuses empty files
+            return False
+        if len(data) < FILE_HEADER.size or not self._use(data, commit):
+            data.close()
+            return False
+        return True
+
+    def _use(self, data, commit):
+        magic, version, hold, cached, count = FILE_HEADER.unpack_from(data)
+        if magic != MAGIC or version != HEADERS_VERSION or cached != commit \
+                or len(data) < FILE_HEADER.size + count * RECORD.size:
+            return False
+        self.data, self.commit, self.hold, self.count = data, cached, bool(hold), count
+        self.strings = FILE_HEADER.size + count * RECORD.size
+        return True
+
+    def build(self, index):
+        """ Rebuilds the cache from the ticket `index` and writes it to disk.
+            If it cannot be written, it is used from memory instead.
+        """
+        data = build(index)
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp, self.filename)
+        except (IOError, OSError):
+            # The cache is merely a cache; it is rebuilt when it cannot be saved
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        if not self.open(str(index.commit)):
+            self._use(data, str(index.commit))
+
+    def __len__(self):
+        return self.count
+
+    def record(self, row):
+        return RECORD.unpack_from(self.data, FILE_HEADER.size + row * RECORD.size)
+
+    def id(self, row):
+        offset = FILE_HEADER.size + row * RECORD.size
+        return self.data[offset:offset + 40]
+
+    def string(self, offset):
+        if offset == MISSING:
+            return None
+        start = self.strings + offset
+        length, = STRING_LENGTH.unpack_from(self.data, start)
+        start += STRING_LENGTH.size
+        return self.data[start:start + length]
+
+    def columns(self):
+        """ Returns a dict mapping each record field (see POSITIONS) to its
+            values in all records, in id order. Every record is unpacked once.
+        """
+        with timing.phase('table'):
+            unpack, data = RECORD.unpack_from, self.data
+            records = [unpack(data, offset) for offset in
+                       xrange(FILE_HEADER.size, self.strings, RECORD.size)]
+            values = records and zip(*records) or [()] * len(POSITIONS)
+        return dict([(name, values[n]) for name, n in POSITIONS.items()])
+
+    def select(self, rows, statuses, releases = None, match = None):
+        """ Yields the `rows` whose ticket has one of `statuses`, is in one of
+            `releases` (or any release) and satisfies the query predicate
+            `match` (see query.compile), if given. The records are read one
+            at a time, unlike with columns(), so the memory use does not grow
+            with the number of rows.
+        """
+        status_at, release_at = POSITIONS['status'], POSITIONS['release']
+        # equal strings share their offset, so each is only looked up once
+        status_ok, release_ok = {}, {}
+        for row in rows:
+            record = self.record(row)
+            offset = record[status_at]
+            if offset not in status_ok:
+                status_ok[offset] = self.string(offset) in statuses
+            if not status_ok[offset]:
+                continue
+            if releases:
+                offset = record[release_at]
+                if offset not in release_ok:
+                    release_ok[offset] = self.string(offset) in releases
+                if not release_ok[offset]:
+                    continue
+            if match is None or match(record[0], self._release(record), self._fields(record)):
+                yield row
+
+    def find(self, prefix):
+        """ Returns the first row whose id is not smaller than `prefix`.
+            Only the records the binary search visits are read.
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.id(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def match(self, prefix):
+        """ Returns the rows of the tickets whose id starts with `prefix`.
+        """
+        prefix = str(prefix)
+        rows = []
+        row = self.find(prefix)
+        while row < self.count and self.id(row).startswith(prefix):
+            rows.append(row)
+            row += 1
+        return rows
+
+    def unique_prefix_length(self, row):
+        """ Returns the length of the shortest prefix of the id of `row` that
+            matches no other ticket, see itindex.TicketIndex.
+        """
+        id = self.id(row)
+        length = 0
+        for neighbour in [row - 1, row + 1]:
+            if 0 <= neighbour < self.count:
+                other = self.id(neighbour)
+                n = 0
+                while n < len(id) and id[n] == other[n]:
+                    n += 1
+                length = max(length, n)
+        return min(length + 1, len(id))
+
+    def release(self, row):
+        return self._release(self.record(row))
+
+    def _release(self, record):
+        return self.string(record[POSITIONS['release']])
+
+    def fields(self, row):
+        """ Returns the header fields of the ticket of `row`, like the ticket
+            index holds them.
+        """
+        return self._fields(self.record(row))
+
+    def _fields(self, record):
+        fields = {}
+        for name in STRING_FIELDS[2:]:
+            value = self.string(record[POSITIONS[name]])
+            if value is not None:
+                fields[HEADER_FIELDS[name]] = value
+        return fields
+
+    def path(self, row):
+        """ Returns the path of the ticket of `row` relative to the branch
+            root (see ticket.ticket_path).
+        """
+        record = self.record(row)
+        return ticket.ticket_path(self._release(record), record[0],
+                                  self.string(record[POSITIONS['layout']]))
+
+    def location(self, row):
+        """ Returns the (blob sha, span) of the ticket of `row`, see
+            itindex.TicketIndex.location.
+        """
+        record = self.record(row)
+        return record[1], record[3] and (record[2], record[3]) or None
+
+    def ticket(self, row, body_loader = None, backward_compatible = True):
+        """ Returns a Ticket built from the header fields of `row`, see
+            itindex.TicketIndex.ticket.
+        """
+        record = self.record(row)
+        fields = self._fields(record)
+        with timing.phase('parse'):
+            return ticket.create_from_fields(fields, record[0], self._release(record),
+                    backward_compatible, body_loader)
+
+#EOF
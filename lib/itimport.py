@@ -0,0 +1,270 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Bulk import of tickets, as done by 'it import'.
+#
+# Tickets are read as records, one JSON object per line or one CSV/TSV row
+# under a header row, with the fields 'it list --format' writes and the body
+# of the ticket. Every record is checked by the rules of the ticket files and
+# of 'it new', and turned into a ticket file right away.
+#
+# The files are streamed into a single 'git fast-import' process, which
+# packs the blobs, trees and commits itself, instead of storing every object
+# through GitPython. The commits go to a private ref; the itdb branch is
+# only advanced to the last one when all records were imported.
+#
+import csv
+import json
+import datetime
+import subprocess
+import it, ticket, itpack, timing
+
+# Fields of a record, see ticket.Ticket.record_fields
+FIELDS = ticket.Ticket.record_fields + [ 'body' ]
+
+TYPES = [ 'bug', 'feature', 'issue', 'task' ]
+STATUSES = [ 'open', 'test', 'closed', 'fixed', 'rejected' ]
+
+# Fields of the records that may be left out or empty, with the defaults of
+# 'it new'; missing issuers and dates are the importing user and now
+DEFAULTS = { 'type': 'issue', 'status': 'open', 'prio': '2', 'weight': '3',
+             'assigned_to': '-', 'release': it.UNCATEGORIZED, 'body': '' }
+
+# Buffered output is written to 'git fast-import' in pieces of this size
+FLUSH_SIZE = 1 << 18
+
+
+class ImportException(Exception): pass
+
+
+def read_records(f, format, errors):
+    """ Yields (line number, record) for the records in the file `f` in
+        'jsonl', 'csv' or 'tsv' format, as dicts mapping FIELDS to strings.
+        Records that cannot be read are skipped and added to `errors`.
+    """
+    if format == 'jsonl':
+        for lineno, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                errors.append("line %d: %s" % (lineno + 1, e))
+                continue
+            if not isinstance(record, dict):
+                errors.append("line %d: Expected a JSON object" % (lineno + 1))
+                continue
+            yield lineno + 1, record
+        return
+
+    if format == 'csv':
+        reader = csv.reader(f)
+        rows = ((reader.line_num, row) for row in reader)
+    else:
+        rows = ((lineno + 1, line.rstrip('\r\n').split('\t')) for lineno, line in enumerate(f))
+    columns = None
+    for lineno, row in rows:
+        if not [value for value in row if value.strip()]:
+            continue
+        if columns is None:
+            columns = [column.strip() for column in row]
+            unknown = [column for column in columns if column not in FIELDS]
+            if unknown:
+                errors.append("line %d: Unknown field '%s'; use %s" % (lineno, unknown[0],
+                        ', '.join(FIELDS)))
+                return
+            continue
+        if len(row) != len(columns):
+            errors.append("line %d: Expected %d fields, found %d" % (lineno, len(columns), len(row)))
+            continue
+        yield lineno, dict(zip(columns, row))
+
+
+def create_ticket(record, issuer):
+    """ Returns the ticket of `record` (see read_records), with the id it
+        gives or None. Fields that are left out get the defaults of 'it new'
+        and `issuer`. Raises an ImportException if a field is invalid.
+    """
+    unknown = [name for name in record if name not in FIELDS]
+    if unknown:
+        raise ImportException("Unknown field '%s'; use %s" % (unknown[0], ', '.join(FIELDS)))
+    values = {}
+    for name in FIELDS:
+        value = record.get(name)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif value is not None:
+            value = str(value)
+        if name != 'body':
+            value = value and value.strip()
+            if value and ('\n' in value or '\r' in value):
+                raise ImportException("The %s contains a line break" % name)
+        values[name] = value or DEFAULTS.get(name)
+
+    if not values['title']:
+        raise ImportException("The title is missing")
+    id = values['id']
+    if id is not None and (len(id) != 40 or id.strip('0123456789abcdef')):
+        raise ImportException("'%s' is not a ticket id" % id)
+    release = values['release']
+    if '/' in release or release.startswith('.'):
+        raise ImportException("'%s' is not a valid release name" % release)
+    if values['type'] not in TYPES:
+        raise ImportException("Unknown type '%s'; use one of %s" % (values['type'], ', '.join(TYPES)))
+    if values['status'] not in STATUSES:
+        raise ImportException("Unknown status '%s'; use one of %s" % (values['status'], ', '.join(STATUSES)))
+
+    names = ticket.Ticket.prio_names
+    prio = values['prio'] in names and str(names.index(values['prio']) + 1) or values['prio']
+    if prio not in [ '1', '2', '3' ]:
+        raise ImportException("'%s' is not a valid priority; use 1-3 or %s" % (prio, ', '.join(names)))
+    names = ticket.Ticket.weight_names
+    weight = values['weight'] in names and str(3 ** names.index(values['weight'])) or values['weight']
+    if not weight.isdigit() or not 1 <= int(weight) <= 27:
+        raise ImportException("'%s' is not a valid weight; use 1-27 or %s" % (weight, ', '.join(names)))
+    date = values['date'] or datetime.datetime.now().strftime(ticket.DATE_FORMAT)
+
+    fields = { 'Subject': values['title'], 'Type': values['type'],
+               'Issuer': values['issuer'] or issuer, 'Date': date,
+               'Priority': prio, 'Weight': weight, 'Status': values['status'],
+               'Assigned to': values['assigned_to'], None: values['body'] }
+    try:
+        i = ticket.create_from_fields(fields, id, release)
+    except ValueError:
+        # the other fields are checked above
+        raise ImportException("'%s' is not a date like 2026-01-31 12:00:00" % date)
+    i.id = id
+    return i
+
+
+def quote_path(path):
+    """ Returns `path` quoted for the commands of 'git fast-import'.
+    """
+    return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"')
+
+
+class FastImport(object):
+    def __init__(self, repo, ref, parent, layout, packs, read_pack):
+        """ Starts a 'git fast-import' process that commits to `ref`, on top
+            of the commit `parent` (a hex SHA, or None) with the tickets in
+            `layout`. In the packed layout, `packs` maps the releases to the
+            blobs of their packs at `parent`, which are read with `read_pack`
+            when tickets are added to them.
+        """
+        self.repo = repo
+        self.ref = ref
+        self.parent = parent
+        self.layout = layout
+        self.packs = packs
+        self.read_pack = read_pack
+        # release -> contents of its pack as last committed
+        self.pack_data = {}
+        self.committer = repo.git.var('GIT_COMMITTER_IDENT')
+        self.commits = 0
+        self.marks = 0
+        # (mark, path) of the blobs, or release -> id -> contents in the
+        # packed layout, of the tickets for the next commit
+        self.pending = []
+        self.pending_packs = {}
+        self.added = 0
+        self.buffer = []
+        self.buffered = 0
+        self.proc = repo.git.fast_import(['--quiet', '--done'], as_process=True,
+                                         istream=subprocess.PIPE)
+
+    def __len__(self):
+        """ Returns the number of tickets added since the last commit.
+        """
+        return self.added
+
+    def write(self, *parts):
+        for part in parts:
+            if isinstance(part, unicode):
+                # names and messages from the git config
+                part = part.encode('utf-8')
+            self.buffer.append(part)
+            self.buffered += len(part)
+        if self.buffered >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        try:
+            self.proc.stdin.write(''.join(self.buffer))
+        except IOError:
+            # it stopped early, its exit status tells why
+            self.check()
+            raise
+        self.buffer, self.buffered = [], 0
+
+    def data(self, contents):
+        if isinstance(contents, unicode):
+            contents = contents.encode('utf-8')
+        self.write('data %d\n' % len(contents), contents, '\n')
+
+    def add(self, i):
+        """ Adds ticket `i` to the next commit.
+        """
+        with timing.phase('render'):
+            contents = i.contents()
+            if isinstance(contents, unicode):
+                contents = contents.encode('utf-8')
+        self.added += 1
+        if self.layout == it.PACKED_LAYOUT:
+            self.pending_packs.setdefault(i.release, {})[i.id] = contents
+            return
+        self.marks += 1
+        self.write('blob\nmark :%d\n' % self.marks)
+        self.data(contents)
+        self.pending.append((self.marks, i.path(self.layout)))
+
+    def commit(self, msg):
+        """ Commits the tickets added since the last commit.
+        """
+        self.write('commit %s\ncommitter %s\n' % (self.ref, self.committer))
+        self.data(msg)
+        if self.commits == 0 and self.parent is not None:
+            self.write('from %s\n' % self.parent)
+        for mark, path in self.pending:
+            self.write('M 100644 :%d %s\n' % (mark, quote_path(path)))
+        for release, records in sorted(self.pending_packs.items()):
+            if release not in self.pack_data:
+                blob = self.packs.get(release)
+                self.pack_data[release] = blob and self.read_pack(blob)
+            data = self.pack_data[release] = itpack.update(self.pack_data[release], records)
+            self.write('M 100644 inline %s\n' % quote_path(itpack.pack_path(release)))
+            self.data(data)
+        self.write('\n')
+        self.pending, self.pending_packs, self.added = [], {}, 0
+        self.commits += 1
+
+    def check(self):
+        """ Waits for 'git fast-import' to exit. Raises an ImportException
+            with its errors if it failed, after removing the private ref.
+        """
+        errors = self.proc.stderr.read().strip()
+        status = self.proc.proc.wait()
+        if status != 0:
+            self.repo.git.update_ref(['-d', self.ref], with_exceptions=False)
+            raise ImportException("'git fast-import' failed: %s"
+                    % (errors or 'exit status %d' % status))
+
+    def finish(self):
+        """ Waits for 'git fast-import' to write everything and returns the
+            hex SHA of the last commit, or None if nothing was committed. The
+            private ref is removed again. Raises an ImportException if 'git
+            fast-import' failed.
+        """
+        self.write('done\n')
+        self.flush()
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            # as in flush, check() tells why
+            pass
+        self.check()
+        if not self.commits:
+            return None
+        commit = self.repo.git.rev_parse(['--verify', self.ref])
+        self.repo.git.update_ref(['-d', self.ref, commit])
+        return commit
+
+#EOF
@@ -0,0 +1,388 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Persistent cache of the parsed ticket headers of the itdb branch.
+#
+# The index is stored under the .git directory together with the SHA of the
+# itdb branch commit it was built from. As long as the branch does not move,
+# the tickets can be listed and matched without reading a single blob. When
+# it does move, only the tickets that changed between the cached commit and
+# the new one are read and parsed again.
+#
+import os
+import marshal
+from bisect import bisect_left, insort
+import it, ticket, timing, itpack
+
+# Bump whenever the layout of the stored data changes
+INDEX_VERSION = 6
+
+# Fewer changed tickets than this are not worth starting workers for
+PARALLEL_MIN_TICKETS = 1000
+
+
+def split_ticket_path(path):
+    """ Returns a (release, id, layout) tuple for the path of a ticket blob
+        relative to the branch root, or None if `path` is not a ticket. Both
+        the flat and the fan-out layout are understood; `layout` tells which
+        one the path is in. Packs are no tickets (see itpack.split_pack_path).
+    """
+    parts = path.split('/')
+    if parts[0] != it.TICKET_DIR or parts[-1].startswith('.'):
+        return None
+    if len(parts) == 3:
+        return parts[1], parts[2], it.FLAT_LAYOUT
+    if len(parts) == 4 and parts[3].startswith(parts[2]) and len(parts[2]) == 2:
+        return parts[1], parts[3], it.FANOUT_LAYOUT
+    return None
+
+
+def changed_records(old, new):
+    """ Returns (id, old contents, new contents) for the tickets that differ
+        between the packs `old` and `new` (None for no pack). The old contents
+        are None for added tickets, the new ones for removed tickets.
+    """
+    old, new = itpack.records(old), itpack.records(new)
+    return [(id, old.get(id), new.get(id))
+            for id in sorted(set(old) | set(new)) if old.get(id) != new.get(id)]
+
+
+def utf8(path):
+    """ Returns `path` as read from git as a utf-8 byte string, like the
+        release names given on the command line.
+    """
+    return isinstance(path, unicode) and path.encode('utf-8') or path
+
+
+def all_paths(repo, commit):
+    """ Yields (path, None, blob sha) for all blobs under the ticket dir of
+        `commit`, in the same form as changed_paths().
+    """
+    with timing.phase('tree walk'):
+        # -z leaves paths with special characters unquoted
+        out = repo.git.ls_tree(['-r', '-z', commit, '--', it.TICKET_DIR])
+    for entry in out.split('\0'):
+        if not entry:
+            continue
+        meta, path = entry.split('\t', 1)
+        _, type, sha = meta.split()
+        if type == 'blob':
+            yield utf8(path), None, sha
+
+
+def changed_paths(repo, old, new):
+    """ Returns (path, old blob sha, new blob sha) for all blobs under the
+        ticket dir that differ between the commits `old` and `new`. The old
+        sha is None for added blobs, the new sha is None for removed ones.
+    """
+    with timing.phase('tree walk'):
+        # -z leaves paths with special characters unquoted and puts them
+        # after a NUL instead of a tab
+        out = repo.git.diff_tree(['-r', '-z', '--no-renames', old, new, '--', it.TICKET_DIR])
+    changes = []
+    fields = out.split('\0')
+    for meta, path in zip(fields[0::2], fields[1::2]):
+        _, _, old_sha, new_sha, status = meta.split()
+        changes.append((utf8(path), status != 'A' and old_sha or None,
+                              status != 'D' and new_sha or None))
+    return changes
+
+
+def read_fields(stream, size = 1 << 16):
+    """ Yields the NUL-terminated fields of the output `stream` of a git
+        command run with -z.
+    """
+    rest = ''
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        fields = (rest + data).split('\0')
+        rest = fields.pop()
+        for field in fields:
+            yield field
+    if rest:
+        yield rest
+
+
+def log_changes(stream, mark):
+    """ Yields (header, changes) for the commits in the output `stream` of
+        'git log --raw -z --no-abbrev' with a --format that starts with
+        `mark`. `header` is the formatted text after `mark`, and `changes`
+        is a list of (path, old blob sha, new blob sha) like changed_paths().
+    """
+    header, changes = None, []
+    fields = read_fields(stream)
+    for field in fields:
+        field = field.lstrip('\n')
+        if field.startswith(mark):
+            if header is not None:
+                yield header, changes
+            header, changes = field[len(mark):], []
+        elif field.startswith(':'):
+            _, _, old_sha, new_sha, status = field.split()
+            changes.append((next(fields), status != 'A' and old_sha or None,
+                            status != 'D' and new_sha or None))
+    if header is not None:
+        yield header, changes
+
+
+def read_headers(repo, blobs, jobs):
+    """ Returns a dict mapping each blob SHA of `blobs` to the header fields
+        of the ticket in it, read and parsed by `jobs` worker processes that
+        each take a consecutive part of the blobs.
+    """
+    import parallel
+    def read_shard(shard):
+        git = repo.GitCommandWrapperType(repo.working_dir or repo.git_dir)
+        try:
+            headers = []
+            for blob in shard:
+                _, _, _, contents = git.get_object_data(blob)
+                headers.append(ticket.parse_lines(contents.split('\n'), True))
+            return headers
+        finally:
+            git.clear_cache()
+
+    # One shard per worker, as each needs its own cat-file process
+    shards = parallel.shards(blobs, jobs)
+    fields = {}
+    for shard, headers in zip(shards, parallel.map(read_shard, shards, jobs)):
+        fields.update(zip(shard, headers))
+    return fields
+
+
+def common_prefix_length(s1, s2):
+    n = 0
+    for c1, c2 in zip(s1, s2):
+        if c1 != c2:
+            break
+        n += 1
+    return n
+
+
+class TicketIndex(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.commit = None
+        self.hold = False
+        # the layout new tickets are stored in
+        self.layout = it.FLAT_LAYOUT
+        # id -> (release, blob sha, header fields, layout, span), where span
+        # is the (offset, length) of the ticket in the pack blob of a packed
+        # ticket and None otherwise
+        self.tickets = {}
+        # release -> blob sha of its pack
+        self.packs = {}
+        # all ticket ids in sorted order, for prefix lookups
+        self.ids = []
+
+    def load(self):
+        """ Reads the index from disk. A missing, unreadable or outdated file
+            leaves the index empty, so that it gets rebuilt on update().
+        """
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if data[0] != INDEX_VERSION:
+            return False
+        _, self.commit, self.hold, self.layout, self.tickets, self.packs, \
+                self.ids = data
+        return True
+
+    def save(self):
+        """ Writes the index to disk. The file is replaced atomically, so
+            concurrent readers never see a partially written index.
+        """
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try:
+                marshal.dump((INDEX_VERSION, self.commit, self.hold,
+                        self.layout, self.tickets, self.packs, self.ids), f)
+            finally:
+                f.close()
+            os.rename(tmp, self.filename)
+        except (IOError, OSError):
+            # The index is merely a cache; it is rebuilt when it cannot be saved
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def update(self, repo, commit, read_blob, jobs = 1):
+        """ Brings the index up to date with `commit` (a hex SHA). Returns
+            True if the index changed.
+
+            If the index was built from another commit, only the tickets that
+            differ between both commits are read again through `read_blob`.
+            Otherwise, the whole ticket tree is indexed from scratch. With
+            `jobs` > 1, many tickets are read by that many worker processes.
+            Of a changed pack, only the tickets that differ are parsed again.
+        """
+        if self.commit == commit:
+            return False
+
+        changes = None
+        if self.commit is not None:
+            try:
+                changes = changed_paths(repo, self.commit, commit)
+            except Exception:
+                # the cached commit may have been pruned after a forced update
+                changes = None
+        rebuild = changes is None
+        if rebuild:
+            self.hold = False
+            self.layout = it.FLAT_LAYOUT
+            self.tickets = {}
+            self.packs = {}
+            self.ids = []
+            changes = all_paths(repo, commit)
+
+        headers = {}
+        if jobs > 1:
+            changes = list(changes)
+            blobs = [blob for path, _, blob in changes if blob is not None
+                     and itpack.split_pack_path(path) is None]
+            if len(blobs) >= PARALLEL_MIN_TICKETS:
+                with timing.phase('parallel reads'):
+                    headers = read_headers(repo, blobs, jobs)
+
+        for path, old_blob, blob in changes:
+            if path == os.path.join(it.TICKET_DIR, it.HOLD_FILE):
+                self.hold = blob is not None
+                continue
+            if path == os.path.join(it.TICKET_DIR, it.LAYOUT_FILE):
+                layout = blob is not None and read_blob(blob).strip()
+                self.layout = layout in it.LAYOUTS and layout or it.FLAT_LAYOUT
+                continue
+            release = itpack.split_pack_path(path)
+            if release is not None:
+                self._update_pack(release, read_blob, old_blob, blob, rebuild)
+                continue
+            location = split_ticket_path(path)
+            if location is None:
+                continue
+            release, id, layout = location
+            if blob is None:
+                self._remove(id, release, layout)
+                continue
+
+            fields = headers.get(blob)
+            if fields is None:
+                contents = read_blob(blob)
+                with timing.phase('parse'):
+                    fields = ticket.parse_lines(contents.split('\n'), True)
+            self._add(id, (release, blob, fields, layout, None), rebuild)
+
+        if rebuild:
+            self.ids.sort()
+        self.commit = commit
+        return True
+
+    def _add(self, id, entry, rebuild):
+        if rebuild:
+            self.ids.append(id)
+        elif id not in self.tickets:
+            insort(self.ids, id)
+        self.tickets[id] = entry
+
+    def _remove(self, id, release, layout):
+        # a moved ticket may already have been added to its new path
+        if id in self.tickets and self.tickets[id][0] == release \
+                and self.tickets[id][3] == layout:
+            del self.tickets[id]
+            del self.ids[bisect_left(self.ids, id)]
+
+    def _update_pack(self, release, read_blob, old, new, rebuild):
+        """ Applies the change of the pack of `release` from blob `old` to
+            blob `new`. Tickets that did not change keep their parsed fields.
+        """
+        data = new and read_blob(new)
+        changed = None
+        if old is not None and not rebuild:
+            changed = set()
+            for id, _, contents in changed_records(read_blob(old), data):
+                if contents is None:
+                    self._remove(id, release, it.PACKED_LAYOUT)
+                else:
+                    changed.add(id)
+        if new is None:
+            self.packs.pop(release, None)
+            return
+
+        self.packs[release] = new
+        for id, span in itpack.read_toc(data).items():
+            entry = self.tickets.get(id)
+            if changed is not None and id not in changed and entry is not None \
+                    and entry[0] == release and entry[3] == it.PACKED_LAYOUT:
+                # only its place in the pack may have changed
+                self.tickets[id] = (release, new, entry[2], entry[3], span)
+                continue
+            offset, length = span
+            with timing.phase('parse'):
+                fields = ticket.parse_lines(
+                        data[offset:offset + length].split('\n'), True)
+            self._add(id, (release, new, fields, it.PACKED_LAYOUT, span), rebuild)
+
+    def match(self, prefix):
+        """ Returns the sorted list of ticket ids that start with `prefix`.
+
+            The matching ids are adjacent in the sorted id list, so finding
+            them takes a binary search plus one step per match.
+        """
+        matches = []
+        pos = bisect_left(self.ids, prefix)
+        while pos < len(self.ids) and self.ids[pos].startswith(prefix):
+            matches.append(self.ids[pos])
+            pos += 1
+        return matches
+
+    def unique_prefix_length(self, id):
+        """ Returns the length of the shortest prefix of `id` that matches no
+            other ticket. Only the sorted neighbours of `id` can share a
+            longer prefix with it, so they are the only ones to look at.
+        """
+        pos = bisect_left(self.ids, id)
+        length = 0
+        for neighbour in self.ids[max(0, pos - 1):pos] + self.ids[pos + 1:pos + 2]:
+            length = max(length, common_prefix_length(id, neighbour))
+        return min(length + 1, len(id))
+
+    def path(self, id):
+        """ Returns the path of ticket `id` relative to the branch root (see
+            ticket.ticket_path for packed tickets).
+        """
+        release, _, _, layout, _ = self.tickets[id]
+        return ticket.ticket_path(release, id, layout)
+
+    def location(self, id):
+        """ Returns the (blob sha, span) of ticket `id`, where span is the
+            (offset, length) of a packed ticket in its pack, or None.
+        """
+        return self.tickets[id][1], self.tickets[id][4]
+
+    def releases(self):
+        """ Returns a dict mapping each release name to the sorted ids of its
+            tickets, i.e. in the order of the release tree.
+        """
+        releases = {}
+        for id, (release, _, _, _, _) in self.tickets.items():
+            releases.setdefault(release, []).append(id)
+        for ids in releases.values():
+            ids.sort()
+        return releases
+
+    def ticket(self, id, body_loader = None, backward_compatible = True):
+        """ Returns a Ticket built from the cached header fields of `id`. The
+            body is not part of the index; it is read through `body_loader`
+            when it is accessed, or left empty.
+        """
+        release, _, fields, _, _ = self.tickets[id]
+        with timing.phase('parse'):
+            return ticket.create_from_fields(fields, id, release,
+                    backward_compatible, body_loader)
+
+#EOF
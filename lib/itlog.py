@@ -0,0 +1,153 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Change history of single tickets, as shown by 'it log'.
+#
+# The history of a ticket comes from one streamed 'git log --raw' over the
+# itdb branch, limited to the paths the ticket can have in any release and
+# layout, so a ticket is followed when it moves to another release. Every
+# commit that changed the ticket becomes an entry that lists the header
+# fields it changed. The histories are cached under the .git directory for
+# the branch commit they were read from.
+#
+import os
+import marshal
+import it, ticket, itpack, timing
+from itindex import log_changes, split_ticket_path
+
+# Bump whenever the layout of the stored data changes
+LOG_VERSION = 2
+
+# The order of the header fields in a ticket file
+FIELD_ORDER = [ 'Subject', 'Issuer', 'Date', 'Type', 'Priority', 'Weight',
+                'Status', 'Assigned to' ]
+
+# Marks a commit in the 'git log' output
+COMMIT_MARK = '\x01'
+
+
+def pathspecs(id):
+    """ Returns the pathspecs of all paths ticket `id` can be stored at.
+    """
+    return [ ':(glob)%s/*/%s' % (it.TICKET_DIR, id),
+             ':(glob)%s/*/%s/%s' % (it.TICKET_DIR, id[:2], id),
+             ':(glob)%s/*/%s' % (it.TICKET_DIR, it.PACK_FILE) ]
+
+
+def ticket_state(path, blob, id, read_blob):
+    """ Returns the (release, contents) of ticket `id` in the blob `blob` at
+        `path`, or None if the blob does not hold it.
+    """
+    if blob is None:
+        return None
+    release = itpack.split_pack_path(path)
+    if release is not None:
+        data = read_blob(blob)
+        span = itpack.read_toc(data).get(id)
+        return span is not None and \
+                (release, data[span[0]:span[0] + span[1]]) or None
+    location = split_ticket_path(path)
+    return location is not None and (location[0], read_blob(blob)) or None
+
+
+def changed_fields(old, new):
+    """ Returns (field, old value, new value) for the changes from ticket
+        state `old` to state `new`. The release counts as a field, the body
+        is field None; a ticket that was added or removed only lists its
+        release, with None for the missing side.
+    """
+    if old is None or new is None:
+        return [('Release', old and old[0], new and new[0])]
+    changes = []
+    if old[0] != new[0]:
+        changes.append(('Release', old[0], new[0]))
+    with timing.phase('parse'):
+        old_fields = ticket.parse_lines(old[1].split('\n'))
+        new_fields = ticket.parse_lines(new[1].split('\n'))
+    fields = [f for f in FIELD_ORDER if f in old_fields or f in new_fields]
+    fields += sorted([f for f in set(old_fields) | set(new_fields)
+                      if f is not None and f not in FIELD_ORDER])
+    for field in fields + [None]:
+        if old_fields.get(field) != new_fields.get(field):
+            changes.append((field, old_fields.get(field), new_fields.get(field)))
+    return changes
+
+
+def read_history(repo, commit, id, read_blob):
+    """ Returns the history of ticket `id` up to `commit`, oldest first, as
+        (commit sha, author, timestamp, subject, changed fields) tuples.
+    """
+    proc = repo.git.log(['--reverse', '--raw', '-z', '--no-renames', '--no-abbrev',
+            '--format=' + COMMIT_MARK + '%H%x1f%an <%ae>%x1f%at%x1f%s',
+            commit, '--'] + pathspecs(id), as_process=True)
+    history = []
+    def add(header, old, new):
+        if header is not None and old != new:
+            sha, author, timestamp, subject = header
+            history.append((sha, author, int(timestamp), subject,
+                            changed_fields(old, new)))
+
+    header = old = new = None
+    for text, changes in log_changes(proc.stdout, COMMIT_MARK):
+        add(header, old, new)
+        header = text.split('\x1f')
+        old = new = None
+        for path, old_blob, new_blob in changes:
+            old = ticket_state(path, old_blob, id, read_blob) or old
+            new = ticket_state(path, new_blob, id, read_blob) or new
+    add(header, old, new)
+    proc.wait()
+    return history
+
+
+class TicketLog(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.commit = None
+        # ticket id -> history, as returned by read_history()
+        self.histories = {}
+
+    def load(self):
+        """ Reads the cache from disk. A missing, unreadable or outdated file
+            leaves it empty.
+        """
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if data[0] != LOG_VERSION:
+            return False
+        _, self.commit, self.histories = data
+        return True
+
+    def save(self):
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try:
+                marshal.dump((LOG_VERSION, self.commit, self.histories), f)
+            finally:
+                f.close()
+            os.rename(tmp, self.filename)
+        except (IOError, OSError):
+            # The cache is merely a cache; it is rebuilt when it cannot be saved
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def history(self, repo, commit, id, read_blob):
+        """ Returns the history of ticket `id` up to `commit` (a hex SHA),
+            from the cache if it was read for that commit. Returns a tuple of
+            the history and whether the cache changed.
+        """
+        if self.commit != commit:
+            self.commit, self.histories = commit, {}
+        if id in self.histories:
+            return self.histories[id], False
+        with timing.phase('history'):
+            self.histories[id] = read_history(repo, commit, id, read_blob)
+        return self.histories[id], True
+
+#EOF
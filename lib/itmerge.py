@@ -0,0 +1,130 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Three-way merge of ticket databases, as done by 'it sync'.
+#
+# The merge works on tickets, not on files: both sides are diffed against
+# their merge base, so only the tickets that changed are read, whatever the
+# layout they are stored in. A ticket changed on one side only is taken from
+# that side. A ticket changed on both sides is merged field by field, where
+# its release counts as one more field; it only conflicts when both sides
+# changed the same field in different ways.
+#
+import it, ticket, itpack
+from itindex import changed_paths, changed_records, split_ticket_path
+
+# The pseudo field that holds the release of a ticket while merging
+RELEASE_FIELD = 'Release'
+
+
+class MergeConflictException(Exception): pass
+
+
+def commit_layout(commit):
+    """ Returns the storage layout of the ticket database in `commit`.
+    """
+    try:
+        blob = commit.tree / it.TICKET_DIR / it.LAYOUT_FILE
+    except KeyError:
+        return it.FLAT_LAYOUT
+    layout = blob.data_stream.read().strip()
+    return layout in it.LAYOUTS and layout or it.FLAT_LAYOUT
+
+
+def changed_tickets(repo, read_blob, old, new):
+    """ Returns a dict mapping the id of every ticket that differs between
+        the commits `old` and `new` to its (old state, new state). A state is
+        a (release, contents) tuple, or None for a ticket that is missing.
+    """
+    states = {}
+    def record(id, release, old_contents, new_contents):
+        state = states.setdefault(id, [None, None])
+        if old_contents is not None:
+            state[0] = (release, old_contents)
+        if new_contents is not None:
+            state[1] = (release, new_contents)
+
+    for path, old_blob, new_blob in changed_paths(repo, old, new):
+        release = itpack.split_pack_path(path)
+        if release is not None:
+            for id, old_contents, new_contents in changed_records(
+                    old_blob and read_blob(old_blob), new_blob and read_blob(new_blob)):
+                record(id, release, old_contents, new_contents)
+            continue
+        location = split_ticket_path(path)
+        if location is not None:
+            release, id, _ = location
+            record(id, release, old_blob and read_blob(old_blob),
+                   new_blob and read_blob(new_blob))
+
+    # a ticket that only moved to another layout did not change
+    return dict([(id, tuple(state)) for id, state in states.items()
+                 if state[0] != state[1]])
+
+
+def fields(state):
+    release, contents = state
+    fields = ticket.parse_lines(contents.split('\n'))
+    fields[RELEASE_FIELD] = release
+    return fields
+
+
+def merge_states(id, base, local, remote):
+    """ Returns the merged state of ticket `id` from its `base`, `local` and
+        `remote` states (see changed_tickets). Raises a
+        MergeConflictException naming the fields both sides changed.
+    """
+    if local == remote or remote == base:
+        return local
+    if local == base:
+        return remote
+    if None in [base, local, remote]:
+        raise MergeConflictException('removed on one side, changed on the other')
+
+    base, local, remote = fields(base), fields(local), fields(remote)
+    merged = {}
+    conflicts = []
+    for key in set(base) | set(local) | set(remote):
+        b, l, r = base.get(key), local.get(key), remote.get(key)
+        if l == r or r == b:
+            value = l
+        elif l == b:
+            value = r
+        else:
+            conflicts.append(key is None and 'body' or key)
+            continue
+        if value is not None:
+            merged[key] = value
+    if conflicts:
+        raise MergeConflictException('both sides changed %s' % ', '.join(sorted(conflicts)))
+
+    release = merged.pop(RELEASE_FIELD)
+    t = ticket.create_from_fields(merged, id, release, True)
+    return release, t.contents()
+
+
+def merge(repo, read_blob, base, local, remote):
+    """ Returns a dict mapping the ids of the tickets whose merged state
+        differs from their `local` one to their (local state, merged state).
+        Raises a MergeConflictException listing all conflicting tickets.
+    """
+    local_changes = changed_tickets(repo, read_blob, base, local)
+    remote_changes = changed_tickets(repo, read_blob, base, remote)
+    merged = {}
+    conflicts = []
+    for id, (base_state, remote_state) in remote_changes.items():
+        if id not in local_changes:
+            merged[id] = (base_state, remote_state)
+            continue
+        local_state = local_changes[id][1]
+        try:
+            state = merge_states(id, base_state, local_state, remote_state)
+        except MergeConflictException as e:
+            conflicts.append("ticket '%s': %s" % (id[:7], e))
+            continue
+        if state != local_state:
+            merged[id] = (local_state, state)
+    if conflicts:
+        raise MergeConflictException('\n'.join(sorted(conflicts)))
+    return merged
+
+#EOF
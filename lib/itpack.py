@@ -0,0 +1,100 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# The packed storage layout.
+#
+# A packed database keeps all tickets of a release in a single blob,
+# tickets/<release>/.pack, so a whole release is loaded with one blob read and
+# a commit touches one tree entry per release. A pack starts with a table of
+# contents, sorted by ticket id, that gives the offset and length of every
+# ticket in the pack; the tickets follow in the same order, each in the same
+# form as a ticket file:
+#
+#   git-it pack 1
+#   <number of tickets>
+#   <id> <offset> <length>
+#   ...
+#   <empty line>
+#   <ticket>...
+#
+# Offsets are zero-padded to a fixed width and count from the start of the
+# pack, so a single ticket can be cut out without parsing the others.
+#
+import os
+import it
+
+PACK_HEADER = 'git-it pack 1'
+NUMBER_WIDTH = 10
+
+
+def pack_path(release):
+    """ Returns the path of the pack of `release` relative to the branch root.
+    """
+    return os.path.join(it.TICKET_DIR, release, it.PACK_FILE)
+
+
+def split_pack_path(path):
+    """ Returns the release of a pack path, or None if `path` is no pack.
+    """
+    parts = path.split('/')
+    if len(parts) == 3 and parts[0] == it.TICKET_DIR and parts[2] == it.PACK_FILE:
+        return parts[1]
+    return None
+
+
+def read_toc(data):
+    """ Returns a dict mapping the ticket ids in pack `data` to their
+        (offset, length) in the pack.
+    """
+    lines = data.split('\n', 2)
+    if lines[0] != PACK_HEADER:
+        raise ValueError('not a git-it pack')
+    toc = {}
+    rest = lines[2]
+    for line in rest.split('\n', int(lines[1]))[:int(lines[1])]:
+        id, offset, length = line.split(' ')
+        toc[id] = (int(offset), int(length))
+    return toc
+
+
+def records(data):
+    """ Returns a dict mapping the ticket ids in pack `data` to their contents.
+    """
+    if not data:
+        return {}
+    return dict([(id, data[offset:offset + length])
+                 for id, (offset, length) in read_toc(data).items()])
+
+
+def build(records):
+    """ Returns the pack holding `records`, a dict mapping ticket ids to their
+        contents, or None if there are no records.
+    """
+    if not records:
+        return None
+    ids = sorted(records)
+    offset = len(PACK_HEADER) + len(str(len(ids))) + 2 + \
+            sum([len(id) + 2 * NUMBER_WIDTH + 3 for id in ids]) + 1
+    toc = [PACK_HEADER, str(len(ids))]
+    for id in ids:
+        toc.append('%s %0*d %0*d' % (id, NUMBER_WIDTH, offset,
+                NUMBER_WIDTH, len(records[id])))
+        offset += len(records[id])
+    return '\n'.join(toc) + '\n\n' + ''.join([records[id] for id in ids])
+
+
+def update(data, changes):
+    """ Returns pack `data` (or None for no pack yet) with `changes` applied,
+        a dict mapping ticket ids to their new contents or to None to remove
+        them. Returns None if no tickets are left.
+    """
+    packed = records(data)
+    for id, contents in changes.items():
+        if contents is None:
+            packed.pop(id, None)
+        else:
+            if not isinstance(contents, bytes):
+                contents = contents.encode('utf-8')
+            packed[id] = contents
+    return build(packed)
+
+#EOF
@@ -0,0 +1,234 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Progress of the releases over time, as shown by 'it stats'.
+#
+# The statistics are aggregated from a single streamed 'git log --raw' over
+# the first-parent history of the itdb branch, so every change of a ticket
+# is counted once, in the week it was committed. Per release and week they
+# hold the change of the total and of the done weight (as defined by the
+# progress bars of 'it list'), and the weight and number of the tickets that
+# were closed. The aggregates are stored under the .git directory together
+# with the state of every ticket and the commit they were built from, so a
+# later run only reads the commits that were added since.
+#
+import os
+import time
+import datetime
+import marshal
+from itertools import chain
+import it, ticket, itpack, itheaders, timing
+from itindex import changed_records, log_changes, split_ticket_path
+
+# Bump whenever the layout of the stored data changes
+STATS_VERSION = 2
+
+# Marks a commit in the 'git log' output
+COMMIT_MARK = '\x01'
+
+# Upper bounds, in days, of the buckets of the time-to-close distribution
+CLOSE_BUCKETS = [ (1, 'a day'), (7, 'a week'), (30, 'a month'), (91, 'a quarter') ]
+
+
+def ticket_state(release, contents):
+    """ Returns the (release, weight, status, creation timestamp) of the
+        ticket file `contents` in `release`. A weight that is not a number
+        counts as the default one, like 'it list' counts it.
+    """
+    with timing.phase('parse'):
+        fields = ticket.parse_lines(contents.split('\n'), True)
+    created = ticket.parse_datetime_string(fields['Date'])
+    weight = itheaders.number(fields.get('Weight'), itheaders.NUMBER_DEFAULTS['Weight'])
+    return (release, weight, fields['Status'],
+            int(time.mktime(created.timetuple())))
+
+
+def weights(state):
+    """ Returns the (total weight, done weight) a ticket in `state` adds to
+        its release, like the progress bars of 'it list' count them.
+    """
+    if state is None or state[2] == 'rejected':
+        return 0, 0
+    return state[1], state[2] not in ['open', 'test'] and state[1] or 0
+
+
+def week_of(timestamp):
+    """ Returns the ISO date of the Monday of the week of `timestamp`.
+    """
+    date = datetime.date.fromtimestamp(timestamp)
+    return (date - datetime.timedelta(days=date.weekday())).isoformat()
+
+
+def is_ancestor(repo, old, new):
+    try:
+        repo.git.merge_base(['--is-ancestor', old, new])
+    except Exception:
+        return False
+    return True
+
+
+def stream_changes(repo, since, commit, read_blob):
+    """ Yields (timestamp, changes) for the first-parent commits after
+        `since` (None for all) up to `commit`, oldest first. `changes` maps
+        the ids of the tickets changed by the commit to their new state (see
+        ticket_state), or to None if they were removed.
+    """
+    revisions = since and ['%s..%s' % (since, commit)] or [commit]
+    proc = repo.git.log(['--reverse', '--first-parent', '-m', '--raw', '-z',
+            '--no-renames', '--no-abbrev', '--format=' + COMMIT_MARK + '%at']
+            + revisions + ['--', it.TICKET_DIR], as_process=True)
+
+    for timestamp, paths in log_changes(proc.stdout, COMMIT_MARK):
+        changes = {}
+        for path, old_blob, new_blob in paths:
+            release = itpack.split_pack_path(path)
+            if release is not None:
+                records = changed_records(old_blob and read_blob(old_blob),
+                                          new_blob and read_blob(new_blob))
+                for id, _, contents in records:
+                    if contents is not None:
+                        changes[id] = ticket_state(release, contents)
+                    else:
+                        changes.setdefault(id, None)
+                continue
+            location = split_ticket_path(path)
+            if location is None:
+                continue
+            release, id, _ = location
+            if new_blob is not None:
+                changes[id] = ticket_state(release, read_blob(new_blob))
+            else:
+                # a moved ticket may already have been added to its new path
+                changes.setdefault(id, None)
+        yield int(timestamp), changes
+    proc.wait()
+
+
+class ReleaseStats(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.commit = None
+        # ticket id -> (release, weight, status, creation timestamp)
+        self.tickets = {}
+        # release -> week -> [total weight change, done weight change,
+        #                     closed weight, closed tickets]
+        self.weeks = {}
+        # release -> seconds from creation to closing, per closed ticket
+        self.close_times = {}
+
+    def load(self):
+        """ Reads the aggregates from disk. A missing, unreadable or outdated
+            file leaves them empty, so that they get rebuilt on update().
+        """
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if data[0] != STATS_VERSION:
+            return False
+        _, self.commit, self.tickets, self.weeks, self.close_times = data
+        return True
+
+    def save(self):
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try:
+                marshal.dump((STATS_VERSION, self.commit, self.tickets,
+                        self.weeks, self.close_times), f)
+            finally:
+                f.close()
+            os.rename(tmp, self.filename)
+        except (IOError, OSError):
+            # The aggregates are merely a cache; they are rebuilt when they cannot be saved
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def update(self, repo, commit, read_blob):
+        """ Brings the aggregates up to date with `commit` (a hex SHA), only
+            reading the commits since the one they were built from, unless
+            the branch was rewritten. Returns True if they changed.
+        """
+        if self.commit == commit:
+            return False
+        since = self.commit
+        if since is not None and not is_ancestor(repo, since, commit):
+            since = None
+        if since is None:
+            self.tickets, self.weeks, self.close_times = {}, {}, {}
+
+        with timing.phase('history'):
+            for timestamp, changes in stream_changes(repo, since, commit, read_blob):
+                for id, state in changes.items():
+                    self._apply(id, state, timestamp)
+        self.commit = commit
+        return True
+
+    def _apply(self, id, new, timestamp):
+        old = self.tickets.get(id)
+        if old == new:
+            return
+        week = week_of(timestamp)
+        for state, sign in [(old, -1), (new, 1)]:
+            if state is not None:
+                total, done = weights(state)
+                counts = self.weeks.setdefault(state[0], {}).setdefault(week, [0, 0, 0, 0])
+                counts[0] += sign * total
+                counts[1] += sign * done
+        if weights(new)[1] and not weights(old)[1]:
+            counts = self.weeks[new[0]][week]
+            counts[2] += new[1]
+            counts[3] += 1
+            self.close_times.setdefault(new[0], []).append(max(0, timestamp - new[3]))
+        if new is None:
+            del self.tickets[id]
+        else:
+            self.tickets[id] = new
+
+    def releases(self):
+        """ Returns the sorted names of the releases that have tickets.
+        """
+        return sorted(set([state[0] for state in self.tickets.values()]))
+
+    def burndown(self, release, weeks):
+        """ Returns (week, weight added, weight closed, tickets closed,
+            weight remaining) for the last `weeks` weeks up to the last week
+            with any activity, including the weeks without changes.
+        """
+        last = max(chain(*[w.keys() for w in self.weeks.values()]))
+        last = datetime.datetime.strptime(last, '%Y-%m-%d').date()
+        first = last - datetime.timedelta(weeks=weeks - 1)
+        changes = self.weeks.get(release, {})
+
+        remaining = 0
+        for week, (total, done, _, _) in changes.items():
+            if week < first.isoformat():
+                remaining += total - done
+        rows = []
+        for n in range(weeks):
+            week = (first + datetime.timedelta(weeks=n)).isoformat()
+            total, done, closed_weight, closed = changes.get(week, [0, 0, 0, 0])
+            remaining += total - done
+            rows.append((week, total, closed_weight, closed, remaining))
+        return rows
+
+    def close_time_distribution(self, release):
+        """ Returns the number of tickets of `release` closed within each of
+            CLOSE_BUCKETS days after they were created and later, and the
+            median and 90th percentile of the time to close in days.
+        """
+        days = sorted([seconds / 86400.0 for seconds in self.close_times.get(release, [])])
+        if not days:
+            return None
+        buckets = [0] * (len(CLOSE_BUCKETS) + 1)
+        for d in days:
+            n = 0
+            while n < len(CLOSE_BUCKETS) and d > CLOSE_BUCKETS[n][0]:
+                n += 1
+            buckets[n] += 1
+        return buckets, days[len(days) // 2], days[min(len(days) - 1, len(days) * 9 // 10)]
+
+#EOF
@@ -0,0 +1,164 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Columnar table of the tickets in the header cache (see itheaders), for
+# report-style commands.
+#
+# The header fields that lists and reports filter, sum and sort on are held
+# in one typed array per field, with a row per record of the header cache,
+# instead of in a dict per ticket. Text fields, like the status or the
+# release, are stored as codes into the sorted list of their values, so
+# every column sorts like the field it holds. Filters, progress sums,
+# group-bys and multi-key sorts then run as bulk operations over whole
+# columns, which keeps the per-ticket work in C rather than in Python.
+#
+import heapq
+from array import array
+from collections import Counter
+from itertools import compress
+import timing
+
+# The columns 'it list --sort' can order by
+SORT_COLUMNS = [ 'prio', 'weight', 'date', 'status', 'type', 'title' ]
+
+# Column -> (field of the header cache records, array type code of numeric
+# columns)
+COLUMNS = { 'prio':     ('prio',     'i'),
+            'weight':   ('weight',   'i'),
+            'date':     ('date_key', 'd'),
+            'status':   ('status',   None),
+            'type':     ('type',     None),
+            'assignee': ('assignee', None),
+            'title':    ('title',    None),
+            'release':  ('release',  None) }
+
+# Statuses that do not count towards the progress of a release, and the ones
+# that do not count as done
+UNCOUNTED_STATUSES = [ 'rejected' ]
+OPEN_STATUSES = [ 'open', 'test' ]
+
+
+class TicketTable(object):
+    def __init__(self, headers):
+        """ Creates the table of the tickets in the header cache `headers`,
+            in id order. The columns are built from the records when they are
+            first used.
+        """
+        self.commit = headers.commit
+        self.headers = headers
+        self._records = None
+        # column -> the sorted values its codes stand for
+        self.names = {}
+
+    def __getattr__(self, column):
+        if column not in COLUMNS:
+            raise AttributeError(column)
+        if self._records is None:
+            self._records = self.headers.columns()
+        field, typecode = COLUMNS[column]
+        values = self._records[field]
+        with timing.phase('table'):
+            if typecode is not None:
+                codes = array(typecode, values)
+            else:
+                # equal strings share their offset into the string table
+                offsets = set(values)
+                strings = dict([(offset, self.headers.string(offset)) for offset in offsets])
+                names = self.names[column] = sorted(set(strings.values()))
+                ranks = dict([(name, n) for n, name in enumerate(names)])
+                codes_of = dict([(offset, ranks[strings[offset]]) for offset in offsets])
+                codes = array('i', map(codes_of.__getitem__, values))
+        setattr(self, column, codes)
+        return codes
+
+    def __len__(self):
+        return len(self.headers)
+
+    def id(self, row):
+        return self.headers.id(row)
+
+    def rows(self):
+        """ Returns all rows, in id order.
+        """
+        return range(len(self.headers))
+
+    def where(self, rows, column, values):
+        """ Returns the `rows` whose `column` holds one of `values`.
+        """
+        column, names = getattr(self, column), self.names[column]
+        codes = set([n for n, name in enumerate(names) if name in values])
+        return list(compress(rows, map(codes.__contains__, map(column.__getitem__, rows))))
+
+    def group_by(self, column, rows = None):
+        """ Returns a dict mapping each value of `column` to the `rows` (or
+            all rows) that hold it, in their order.
+        """
+        if rows is None:
+            rows = self.rows()
+        column, names = getattr(self, column), self.names[column]
+        groups = {}
+        for row, code in zip(rows, map(column.__getitem__, rows)):
+            groups.setdefault(code, []).append(row)
+        return dict([(names[code], group) for code, group in groups.items()])
+
+    def counts(self, column, rows = None):
+        """ Returns a dict mapping each value of `column` to the number of
+            `rows` (or all rows) that hold it.
+        """
+        if rows is None:
+            rows = self.rows()
+        column, names = getattr(self, column), self.names[column]
+        counts = Counter(map(column.__getitem__, rows))
+        return dict([(names[code], n) for code, n in counts.items()])
+
+    def progress(self, rows):
+        """ Returns the total and the done weight of `rows`, as the progress
+            bars of 'it list' show them.
+        """
+        status, names = self.status, self.names['status']
+        counted = set([n for n, name in enumerate(names) if name not in UNCOUNTED_STATUSES])
+        done = set([n for n in counted if names[n] not in OPEN_STATUSES])
+        weights = map(self.weight.__getitem__, rows)
+        statuses = map(status.__getitem__, rows)
+        return sum(compress(weights, map(counted.__contains__, statuses))), \
+               sum(compress(weights, map(done.__contains__, statuses)))
+
+    def sort(self, rows, order):
+        """ Returns `rows` sorted by `order`, a list of SORT_COLUMNS that are
+            prefixed with '-' to sort in descending order. Rows that compare
+            equal keep their order.
+
+            Each column is one stable sort pass, least significant first, so
+            the sort keys are plain array lookups instead of Python tuples.
+        """
+        rows = list(rows)
+        for name in reversed(order):
+            column = getattr(self, name.lstrip('-'))
+            rows.sort(key=column.__getitem__, reverse=name.startswith('-'))
+        return rows
+
+    def sort_key(self, order):
+        """ Returns a function that maps a row to its sort key for `order`
+            (see sort). Descending columns are negated, which works for the
+            codes of the text columns as well.
+        """
+        columns = [(getattr(self, name.lstrip('-')), name.startswith('-') and -1 or 1)
+                   for name in order]
+        if len(columns) == 1 and columns[0][1] == 1:
+            return columns[0][0].__getitem__
+        def key(row):
+            return tuple([sign * column[row] for column, sign in columns])
+        return key
+
+    def page(self, rows, order, limit = None, offset = 0):
+        """ Returns the `limit` rows (or all) after the first `offset` ones of
+            `rows` sorted by `order` (see sort). With a limit, only the first
+            offset + limit rows are kept in a heap, which takes O(n log k)
+            instead of sorting all n rows.
+        """
+        if limit is None:
+            return self.sort(rows, order)[offset:]
+        if not order:
+            return list(rows)[offset:offset + limit]
+        return heapq.nsmallest(offset + limit, rows, key=self.sort_key(order))[offset:]
+
+#EOF
@@ -1,6 +1,6 @@
 #vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
 
-import os, errno, dircache
+import os, errno
 import log
 
 def chop(s, maxlen = 20, suffix = ''):
@@ -18,38 +18,6 @@ def pad_to_length(s, width):
 def mkdirs(newdir):
     return os.system('mkdir -p "%s"' % newdir) == 0
 
-def rmdirs(dir):
-    if not os.path.exists(dir):
-        return True
-
-    if not os.path.isdir(dir):
-        log.printerr("'%s': not a directory" % dir)
-        return False
-
-    # First, remove all children of dir
-    ls = dircache.listdir(dir)
-    ok = True
-    for file in ls:
-        full = os.path.join(dir, file)
-        if os.path.isdir(full):
-            if not rmdirs(full):
-                ok = False
-        else:
-            try:
-                os.remove(full)
-            except OSError as e:
-                log.printerr("Could not remove file '%s'" % full)
-                ok = False
-
-    # Finally, remove the empty dir itself
-    if ok:
-        try:
-            os.rmdir(dir)
-        except OSError as e:
-            log.printerr("Could not remove directory '%s'" % dir)
-            ok = False
-    return ok
-
 def read_file_contents(filename):
     try:
         f = open(filename, 'r')
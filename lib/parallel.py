@@ -0,0 +1,101 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Process pool for the opt-in parallel paths of 'it -j <n>'.
+#
+# The workers are forked after the work has been set up, so they inherit the
+# function to run and its items, including Gitit, its repository and the
+# ticket index, without pickling any of it. Only item numbers go out and the
+# (picklable) results come back, in the order of the items, so the output
+# never depends on which worker finished first.
+#
+# Workers must not use the persistent 'git cat-file' processes of the parent;
+# they get their own through a fresh repo.GitCommandWrapperType. The git
+# commands they run are added to the accounting of the parent (see gitcmd).
+#
+import sys
+import signal
+import multiprocessing
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+import gitcmd
+
+# The work of the current map() call, inherited by the forked workers
+_func = None
+_items = None
+
+
+def _run(i):
+    spawned, requests = len(gitcmd.spawned), list(gitcmd.requests)
+    result = _func(_items[i])
+    return result, gitcmd.spawned[spawned:], \
+            [now - before for now, before in zip(gitcmd.requests, requests)]
+
+
+def _init_worker():
+    # Let the parent handle CTRL-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def map(func, items, jobs):
+    """ Returns [func(item) for item in items], computed by up to `jobs`
+        forked worker processes. Runs in-process when `jobs` is 1 or there
+        is at most one item.
+    """
+    global _func, _items
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    _func, _items = func, items
+    pool = multiprocessing.Pool(min(jobs, len(items)), _init_worker)
+    try:
+        replies = pool.map(_run, range(len(items)), 1)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _func, _items = None, None
+
+    results = []
+    for result, spawned, requests in replies:
+        gitcmd.spawned.extend(spawned)
+        for i, value in enumerate(requests):
+            gitcmd.requests[i] += value
+        results.append(result)
+    return results
+
+
+def map_output(func, items, jobs):
+    """ Like map(), for a `func` that prints: the output of every item is
+        written to stdout in the order of the items.
+    """
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    def captured(item):
+        out = StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            result = func(item)
+        finally:
+            sys.stdout = stdout
+        return out.getvalue(), result
+
+    results = []
+    for output, result in map(captured, items, jobs):
+        sys.stdout.write(output)
+        results.append(result)
+    return results
+
+
+def shards(items, count):
+    """ Splits `items` in up to `count` consecutive, nearly equal parts.
+    """
+    count = max(1, min(count, len(items)))
+    return [items[i * len(items) // count:(i + 1) * len(items) // count]
+            for i in range(count)]
+
+#EOF
@@ -0,0 +1,237 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# The query language of 'it list --where'.
+#
+# A query combines comparisons of ticket fields with 'and', 'or', 'not' and
+# parentheses, for example:
+#
+#   status in (open,test) and prio<=2 and assigned=me and date>2026-01-01
+#
+# Comparisons are <field> <op> <value> with the operators = != < <= > >= and
+# ~ (contains, ignoring case), or <field> [not] in (<value>,...). Values may
+# be quoted. Dates compare at the precision given, so date=2026-01 matches
+# the tickets of that month, and assigned=me the tickets of the user.
+#
+# A query is parsed once into a tree and compiled into a predicate on the
+# release and the header fields of a ticket, as cached in the ticket index,
+# so tickets that do not match are never read or created.
+#
+# This module does not depend on GitPython, so 'it' can check a query before
+# it loads anything heavy.
+#
+import re
+
+# Query field -> (header field, type); release and id are not header fields
+FIELDS = { 'status':   ('Status', str),
+           'type':     ('Type', str),
+           'prio':     ('Priority', int),
+           'weight':   ('Weight', int),
+           'date':     ('Date', str),
+           'assigned': ('Assigned to', str),
+           'issuer':   ('Issuer', str),
+           'title':    ('Subject', str),
+           'release':  (None, str),
+           'id':       (None, str) }
+
+# Names that may be used for the values of numeric fields
+VALUE_NAMES = { 'prio':   { 'high': 1, 'med': 2, 'medium': 2, 'low': 3 },
+                'weight': { 'small': 1, 'minor': 3, 'major': 9, 'super': 27 } }
+
+# Values of fields the ticket files lack, like weights of old tickets
+DEFAULTS = { 'Weight': '3' }
+
+OPERATORS = [ '=', '!=', '<', '<=', '>', '>=', '~' ]
+KEYWORDS = [ 'and', 'or', 'not', 'in' ]
+
+COMPARE = { '=':  lambda a, b: a == b, '!=': lambda a, b: a != b,
+            '<':  lambda a, b: a < b,  '<=': lambda a, b: a <= b,
+            '>':  lambda a, b: a > b,  '>=': lambda a, b: a >= b }
+
+TOKEN = re.compile(r'''\s*(?:(<=|>=|!=|[=<>~(),])|"([^"]*)"|'([^']*)'|([^\s=!<>~(),'"]+))''')
+
+
+class QueryException(Exception): pass
+
+
+def tokenize(text):
+    """ Returns the (kind, text) tokens of query `text`, where kind is 'op'
+        for operators and punctuation, 'word' for keywords and 'value' for
+        anything else.
+    """
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN.match(text, pos)
+        if m is None or m.end() == pos:
+            raise QueryException("Cannot parse query at '%s'" % text[pos:].strip())
+        op, dquoted, squoted, word = m.groups()
+        if op is not None:
+            tokens.append(('op', op))
+        elif word is not None and word.lower() in KEYWORDS:
+            tokens.append(('word', word.lower()))
+        else:
+            tokens.append(('value', [v for v in (dquoted, squoted, word) if v is not None][0]))
+        pos = m.end()
+    return tokens
+
+
+class Parser(object):
+    """ Recursive descent parser of the query grammar:
+
+          query      := conjunction ('or' conjunction)*
+          conjunction:= negation ('and' negation)*
+          negation   := 'not' negation | '(' query ')' | comparison
+          comparison := field op value | field ['not'] 'in' '(' value (',' value)* ')'
+
+        The tree is made of tuples: ('or', a, b), ('and', a, b), ('not', a),
+        ('cmp', field, op, value) and ('in', field, [values]).
+    """
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.pos < len(self.tokens) and self.tokens[self.pos] or (None, None)
+
+    def take(self, kind = None, text = None):
+        token = self.peek()
+        if (kind and token[0] != kind) or (text and token[1] != text):
+            found = token[1] is None and 'the end of the query' or "'%s'" % token[1]
+            raise QueryException("Expected %s, found %s" % (text and "'%s'" % text
+                    or kind == 'value' and 'a value' or 'a field', found))
+        self.pos += 1
+        return token[1]
+
+    def parse(self):
+        tree = self.query()
+        if self.pos < len(self.tokens):
+            raise QueryException("Unexpected '%s'" % self.tokens[self.pos][1])
+        return tree
+
+    def query(self):
+        tree = self.conjunction()
+        while self.peek() == ('word', 'or'):
+            self.take()
+            tree = ('or', tree, self.conjunction())
+        return tree
+
+    def conjunction(self):
+        tree = self.negation()
+        while self.peek() == ('word', 'and'):
+            self.take()
+            tree = ('and', tree, self.negation())
+        return tree
+
+    def negation(self):
+        if self.peek() == ('word', 'not'):
+            self.take()
+            return ('not', self.negation())
+        if self.peek() == ('op', '('):
+            self.take()
+            tree = self.query()
+            self.take('op', ')')
+            return tree
+        return self.comparison()
+
+    def comparison(self):
+        field = self.take('value').lower()
+        if field not in FIELDS:
+            raise QueryException("Unknown field '%s'; use one of %s" %
+                    (field, ', '.join(sorted(FIELDS))))
+        negated = self.peek() == ('word', 'not')
+        if negated:
+            self.take()
+        if negated or self.peek() == ('word', 'in'):
+            self.take('word', 'in')
+            self.take('op', '(')
+            values = [self.value(field)]
+            while self.peek() == ('op', ','):
+                self.take()
+                values.append(self.value(field))
+            self.take('op', ')')
+            tree = ('in', field, values)
+            return negated and ('not', tree) or tree
+        op = self.peek()[1]
+        if self.peek()[0] != 'op' or op not in OPERATORS:
+            raise QueryException("Expected one of %s after '%s'" % (' '.join(OPERATORS), field))
+        self.take()
+        return ('cmp', field, op, self.value(field))
+
+    def value(self, field):
+        value = self.take('value')
+        if FIELDS[field][1] is int:
+            value = VALUE_NAMES.get(field, {}).get(value.lower(), value)
+            try:
+                return int(value)
+            except ValueError:
+                raise QueryException("'%s' is not a valid %s" % (value, field))
+        return value
+
+
+def parse(text):
+    """ Returns the tree of query `text`. Raises a QueryException with a
+        message for the user if it is not a valid query.
+    """
+    return Parser(text).parse()
+
+
+def fields(tree):
+    """ Returns the set of the fields the parsed query `tree` compares.
+    """
+    if tree[0] in [ 'and', 'or' ]:
+        return fields(tree[1]) | fields(tree[2])
+    if tree[0] == 'not':
+        return fields(tree[1])
+    return set([tree[1]])
+
+
+def compile(tree, me = None):
+    """ Returns a predicate on (id, release, header fields) for the parsed
+        query `tree`. The value 'me' of the assigned field stands for `me`.
+    """
+    kind = tree[0]
+    if kind in [ 'and', 'or' ]:
+        left, right = compile(tree[1], me), compile(tree[2], me)
+        if kind == 'and':
+            return lambda id, release, fields: left(id, release, fields) and right(id, release, fields)
+        return lambda id, release, fields: left(id, release, fields) or right(id, release, fields)
+    if kind == 'not':
+        inner = compile(tree[1], me)
+        return lambda id, release, fields: not inner(id, release, fields)
+
+    field = tree[1]
+    header, convert = FIELDS[field]
+    def column(id, release, fields):
+        if field == 'release':
+            return release
+        if field == 'id':
+            return id
+        return convert(fields.get(header, DEFAULTS.get(header, '')))
+    def resolve(value):
+        return field == 'assigned' and value == 'me' and me or value
+
+    if kind == 'in':
+        values = set([resolve(v) for v in tree[2]])
+        return lambda id, release, fields: column(id, release, fields) in values
+
+    op, value = tree[2], resolve(tree[3])
+    if field == 'id' and op == '=':
+        # ids are given abbreviated
+        return lambda id, release, fields: id.startswith(value)
+    if field == 'date' and op != '~':
+        # dates compare at the precision given, so date=2026-01 is a month
+        return compile_date(op, value)
+    if op == '~':
+        value = ('%s' % value).lower()
+        return lambda id, release, fields: value in ('%s' % column(id, release, fields)).lower()
+    compare = COMPARE[op]
+    return lambda id, release, fields: compare(column(id, release, fields), value)
+
+
+def compile_date(op, value):
+    compare = COMPARE[op]
+    n = len(value)
+    return lambda id, release, fields: compare(fields.get('Date', '')[:n], value)
+
+#EOF
@@ -0,0 +1,242 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Full-text search over the tickets of the itdb branch.
+#
+# An inverted index maps every term of the Subject, Issuer and body of the
+# tickets to the tickets containing it. Like the ticket index, it is stored
+# under the .git directory with the itdb commit it was built from and is
+# updated from a diff-tree when the branch moves. The postings of a term are
+# kept as a packed array of (document number, term frequency) pairs, so
+# loading the index does not create an object per posting.
+#
+import os, re
+import math
+import marshal
+from array import array
+import ticket, timing, itpack
+from itindex import all_paths, changed_paths, changed_records, split_ticket_path
+
+# Bump whenever the layout of the stored data changes
+SEARCH_VERSION = 2
+
+# Terms in the subject count this many times
+SUBJECT_BOOST = 3
+
+# BM25 ranking parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """ Returns the lower-cased words of `text`.
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    return [w.encode('utf-8') for w in re.findall(r'\w+', text.lower(), re.UNICODE)]
+
+
+def ticket_terms(contents):
+    """ Returns a dict mapping the terms of a ticket file to their frequency.
+    """
+    with timing.phase('parse'):
+        fields = ticket.parse_lines(contents.split('\n'))
+        words = tokenize(fields.get('Subject', '')) * SUBJECT_BOOST + \
+                tokenize(fields.get('Issuer', '')) + tokenize(fields[None])
+    terms = {}
+    for word in words:
+        terms[word] = terms.get(word, 0) + 1
+    return terms
+
+
+def ticket_changes(changes, read_blob):
+    """ Returns (id, old, new) for the tickets changed by `changes` (see
+        itindex.changed_paths), where `old` and `new` return the contents of
+        both versions, or are None for added and removed tickets. A changed
+        pack only contributes the tickets that differ.
+    """
+    def reader(blob):
+        return blob is not None and (lambda: read_blob(blob)) or None
+    def constant(contents):
+        return contents is not None and (lambda: contents) or None
+
+    result = []
+    for path, old, new in changes:
+        if itpack.split_pack_path(path) is not None:
+            for id, old_contents, new_contents in changed_records(
+                    old and read_blob(old), new and read_blob(new)):
+                result.append((id, constant(old_contents), constant(new_contents)))
+            continue
+        location = split_ticket_path(path)
+        if location is not None:
+            result.append((location[1], reader(old), reader(new)))
+    return result
+
+
+def unpack(postings):
+    a = array('I')
+    if postings:
+        a.fromstring(postings)
+    return a
+
+
+class SearchIndex(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.commit = None
+        # ticket id -> (document number, number of terms)
+        self.docs = {}
+        # document number -> ticket id, None for free numbers
+        self.ids = []
+        # term -> packed array of document number, frequency pairs
+        self.postings = {}
+        # term -> unpacked postings, and free document numbers, while updating
+        self._arrays = {}
+        self._free = []
+
+    def load(self):
+        """ Reads the index from disk. A missing, unreadable or outdated file
+            leaves the index empty, so that it gets rebuilt on update().
+        """
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if data[0] != SEARCH_VERSION:
+            return False
+        _, self.commit, self.docs, self.ids, self.postings = data
+        return True
+
+    def save(self):
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try:
+                marshal.dump((SEARCH_VERSION, self.commit, self.docs,
+                        self.ids, self.postings), f)
+            finally:
+                f.close()
+            os.rename(tmp, self.filename)
+        except (IOError, OSError):
+            # The index is merely a cache; it is rebuilt when it cannot be saved
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def update(self, repo, commit, read_blob):
+        """ Brings the index up to date with `commit` (a hex SHA), reading
+            only the tickets that changed since the indexed commit. Returns
+            True if the index changed.
+        """
+        if self.commit == commit:
+            return False
+
+        changes = None
+        if self.commit is not None:
+            try:
+                changes = changed_paths(repo, self.commit, commit)
+            except Exception:
+                changes = None
+        if changes is not None and len(changes) > len(self.docs):
+            # e.g. after 'it migrate': starting over is cheaper
+            changes = None
+        if changes is None:
+            self.docs, self.ids, self.postings = {}, [], {}
+            changes = all_paths(repo, commit)
+
+        # Remove all old versions before adding the new ones, so that a
+        # ticket moved to another release is never removed after its re-add
+        changes = ticket_changes(changes, read_blob)
+        self._free = [docno for docno, id in enumerate(self.ids) if id is None]
+        removed = {}
+        for id, old, _ in changes:
+            if old is not None and id in self.docs:
+                for term in ticket_terms(old()):
+                    removed.setdefault(term, set()).add(self.docs[id][0])
+                self._remove(id)
+        for term, docnos in removed.items():
+            self._remove_postings(term, docnos)
+        for id, _, new in changes:
+            if new is not None:
+                self._add(id, ticket_terms(new()))
+
+        # Pack the postings that changed only once
+        for term, postings in self._arrays.items():
+            if postings:
+                self.postings[term] = postings.tostring()
+            else:
+                self.postings.pop(term, None)
+        self._arrays = {}
+
+        self.commit = commit
+        return True
+
+    def _postings(self, term):
+        if term not in self._arrays:
+            self._arrays[term] = unpack(self.postings.get(term))
+        return self._arrays[term]
+
+    def _add(self, id, terms):
+        if self._free:
+            docno = self._free.pop()
+            self.ids[docno] = id
+        else:
+            docno = len(self.ids)
+            self.ids.append(id)
+        self.docs[id] = (docno, sum(terms.values()))
+        for term, freq in terms.items():
+            self._postings(term).extend([docno, freq])
+
+    def _remove(self, id):
+        docno, _ = self.docs.pop(id)
+        self.ids[docno] = None
+        self._free.append(docno)
+
+    def _remove_postings(self, term, docnos):
+        # All removed documents at once, as each removal scans all postings
+        postings = self._postings(term)
+        kept = array('I')
+        for i in range(0, len(postings), 2):
+            if postings[i] not in docnos:
+                kept.extend(postings[i:i+2])
+        self._arrays[term] = kept
+
+    def search(self, words):
+        """ Returns (score, ticket id) tuples for all tickets that contain
+            every term of `words`, best match first, ranked by BM25.
+        """
+        terms = tokenize(' '.join(words))
+        if not terms or not self.docs:
+            return []
+
+        total = len(self.docs)
+        avg_length = float(sum([n for _, n in self.docs.values()])) / total
+        lengths = {}
+        for docno, n in self.docs.values():
+            lengths[docno] = n
+
+        scores = None
+        for term in set(terms):
+            postings = unpack(self.postings.get(term))
+            df = len(postings) // 2
+            if df == 0:
+                return []
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            term_scores = {}
+            for i in range(0, len(postings), 2):
+                docno, freq = postings[i], postings[i+1]
+                norm = K1 * (1 - B + B * lengths[docno] / avg_length)
+                term_scores[docno] = idf * freq * (K1 + 1) / (freq + norm)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = dict([(d, s + term_scores[d]) for d, s in scores.items()
+                               if d in term_scores])
+
+        results = [(score, self.ids[docno]) for docno, score in scores.items()]
+        results.sort(key=lambda r: (-r[0], r[1]))
+        return results
+
+#EOF
@@ -0,0 +1,103 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# The 'it serve' daemon.
+#
+# Keeps a Gitit instance, with its Repo, ticket header cache and table alive
+# and runs the read-only calls of client.SERVED_CALLS for 'it' processes that
+# connect to its Unix socket in the .git directory. The cache is brought up
+# to date and the git config is read again on every call, so the daemon
+# never serves stale data.
+#
+import os, sys
+import socket
+import signal
+import json
+import traceback
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+import log, client
+
+
+def read_request(conn):
+    data = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    return json.loads(b''.join(data).decode('utf-8'))
+
+
+def run_call(g, request):
+    """ Runs a single request on Gitit instance `g` and returns the reply,
+        with the output of the call captured instead of printed.
+    """
+    out, err = StringIO(), StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = out, err
+    status = 0
+    try:
+        try:
+            if request['call'] not in client.SERVED_CALLS:
+                raise ValueError("call '%s' is not served" % request['call'])
+            g.term_width = request.get('width') or 80
+            g.reload_config()
+            getattr(g, request['call'])(*request['args'])
+        except SystemExit as e:
+            status = e.code or 0
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        g.term_width = None
+    return { 'out': out.getvalue(), 'err': err.getvalue(), 'status': status }
+
+
+def serve(g):
+    """ Serves requests for Gitit instance `g` until interrupted.
+    """
+    path = client.socket_path(g.repo.git_dir)
+    sock = client.connect(g.repo.git_dir)
+    if sock is not None:
+        sock.close()
+        log.printerr("A daemon is already serving this repository.")
+        sys.exit(1)
+    if os.path.exists(path):
+        # left behind by a daemon that was killed
+        os.remove(path)
+
+    # Warm up before accepting connections
+    g.load_table()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+    sock.listen(16)
+
+    # Remove the socket on 'kill' as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving tickets on %s (press CTRL-C to stop)" % path)
+    sys.stdout.flush()
+    try:
+        while True:
+            conn, _ = sock.accept()
+            try:
+                reply = run_call(g, read_request(conn))
+                conn.sendall(json.dumps(reply).encode('utf-8'))
+            except (socket.error, ValueError) as e:
+                log.printerr("Bad request: %s" % e)
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.remove(path)
+
+#EOF
@@ -7,7 +7,6 @@ import math
 import misc
 import log
 import it
-from git import Repo
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
@@ -104,13 +103,25 @@ to set the email address.
     i.issuer = '%s <%s>' % (fullname, email)
     return i
 
-def create_from_lines(array_with_lines, id = None, release = None, backward_compatible = False):
-    # Create an empty ticket
-    i = Ticket()
-
-    # Parse the lines
+def ticket_path(release, id, layout = it.FLAT_LAYOUT):
+    """ Returns the path of ticket `id` in `release` relative to the itdb
+        branch root. In the fan-out layout, tickets are spread over subtrees
+        named after the first two characters of their id, like .git/objects,
+        so that no tree gets too large. In the packed layout, this is the path
+        the ticket would have in the flat layout; it only names the ticket.
+    """
+    if layout == it.FANOUT_LAYOUT:
+        return os.path.join(it.TICKET_DIR, release, id[:2], id)
+    return os.path.join(it.TICKET_DIR, release, id)
+
+def parse_lines(array_with_lines, header_only = False):
+    """ Parses the lines of a ticket file into a dict mapping the header field
+        names to their values. The body is stored under the key None, unless
+        `header_only` is set, in which case parsing stops at the first empty
+        line and the body is left out.
+    """
     ticket = {}
-    ticket[None] = ''
+    body = []
     in_body = False
     for line in array_with_lines:
         # skip comment lines
@@ -119,8 +130,10 @@ def create_from_lines(array_with_lines, id = None, release = None, backward_comp
 
         # when we're in the body, just append lines
         if in_body or line.strip() == '':
+            if header_only:
+                break
             in_body = True
-            ticket[None] += line + os.linesep
+            body.append(line + os.linesep)
             continue
 
         pos = line.find(':')
@@ -131,6 +144,31 @@ def create_from_lines(array_with_lines, id = None, release = None, backward_comp
         val = line[pos+1:].strip()
         ticket[key] = val
 
+    if not header_only:
+        ticket[None] = ''.join(body)
+    return ticket
+
+def parse_body(contents):
+    """ Returns the body of the ticket file `contents`.
+    """
+    return parse_lines(contents.split('\n'))[None].strip()
+
+def create_from_lines(array_with_lines, id = None, release = None, backward_compatible = False, body_loader = None):
+    """ Creates a ticket from the lines of a ticket file. If `body_loader` is
+        given, only the header is parsed and the body is read through
+        `body_loader` when it is first accessed.
+    """
+    fields = parse_lines(array_with_lines, body_loader is not None)
+    return create_from_fields(fields, id, release, backward_compatible, body_loader)
+
+def create_from_fields(ticket, id = None, release = None, backward_compatible = False, body_loader = None):
+    """ Creates a ticket from a dict of header fields as returned by
+        parse_lines(). If the body (key None) is missing, it is read through
+        `body_loader` when first accessed, or taken as empty.
+    """
+    # Create an empty ticket
+    i = Ticket()
+
     # Validate if all fields are present
     requires_fields_set = ['Subject', 'Type', 'Issuer', 'Date', 'Priority',
              'Status', 'Assigned to']
@@ -145,10 +183,17 @@ def create_from_lines(array_with_lines, id = None, release = None, backward_comp
     i.type = ticket['Type']
     i.issuer = ticket['Issuer']
     i.date = parse_datetime_string(ticket['Date'])
-    i.body = ticket[None].strip()
-    i.prio = int(ticket['Priority'])
-    if ticket.has_key('Weight'):  # weight was added later, be backward compatible
-        i.weight = int(ticket['Weight'])
+    if ticket.has_key(None):
+        i.body = ticket[None].strip()
+    else:
+        i.body = None
+        i.body_loader = body_loader
+    try:
+        i.prio = int(ticket['Priority'])
+        if ticket.has_key('Weight'):  # weight was added later, be backward compatible
+            i.weight = int(ticket['Weight'])
+    except ValueError as e:
+        raise MalformedTicketFieldException, 'Priority and weight must be numbers: %s' % e
     i.status = ticket['Status']
     i.assigned_to = ticket['Assigned to']
 
@@ -188,7 +233,11 @@ def create_from_file(filename, overwrite_id = None, overwrite_release = None):
         return create_from_string(content, id, release)
 
 
-class Ticket:
+class Ticket(object):
+    # Keep the tickets compact, there may be many thousands of them in memory
+    __slots__ = ( 'title', 'type', 'issuer', 'date', '_body', 'body_loader',
+                  'prio', 'id', 'status', 'assigned_to', 'weight', 'release' )
+
     # Private fields
     prio_names = [ 'high', 'med', 'low' ]
     prio_colors = { 'high': 'red-on-white', 'med': 'yellow-on-white', 'low': 'white' }
@@ -203,20 +252,35 @@ class Ticket:
     # and to get the most appropriate name back from a number:
     #   approx_name = weight_names[min(3,max(0, int(round(math.log(weight, 3)))))]
     weight_names = [ 'small', 'minor', 'major', 'super' ]
+    # names of the values returned by record()
+    record_fields = [ 'id', 'release', 'type', 'status', 'prio', 'weight',
+                      'date', 'assigned_to', 'issuer', 'title' ]
 
     def __init__(self):
         self.title = ''
         self.type = 'issue'
         self.issuer = ''
         self.date = datetime.datetime.now()
-        self.body = ''
+        self._body = ''
+        self.body_loader = None
         self.prio = 3
         self.id = '000000'
         self.status = 'open'
         self.assigned_to = '-'
         self.weight = 3  # the weight of 'minor' by default
         self.release = it.UNCATEGORIZED
-        self.working_dir = Repo().working_dir
+
+    def _get_body(self):
+        if self._body is None:
+            self._body = self.body_loader and self.body_loader().strip() or ''
+            self.body_loader = None
+        return self._body
+
+    def _set_body(self, body):
+        self._body = body
+
+    # the body of a ticket that was parsed header-only is loaded on first use
+    body = property(_get_body, _set_body)
 
     def is_mine(self, fullname):
         return self.assigned_to == fullname
@@ -252,16 +316,27 @@ class Ticket:
                                                                             misc.pad_to_length(self.status, 8),                             \
                                         colors.colors['default']))
             elif id == 'prio':
-                priostr = self.prio_names[self.prio-1]
+                try:
+                    priostr = self.prio_names[self.prio-1]
+                except IndexError:
+                    priostr = self.prio_names[min(len(self.prio_names), max(1, self.prio)) - 1]
                 colstrings.append('%s%s%s' % (colors.colors[self.prio_colors[priostr]],              \
                                                                             misc.pad_to_length(priostr, 4),
                                         colors.colors['default']))
             elif id == 'wght':
-                weightstr = self.weight_names[min(3, max(0, int(round(math.log(self.weight, 3)))))]
+                weightstr = self.weight_names[min(3, max(0, int(round(math.log(max(1, self.weight), 3)))))]
                 colstrings.append(misc.pad_to_length(weightstr, 5))
 
         return ' '.join(colstrings)
 
+    def record(self):
+        """ Returns the header values of this ticket, in the order of
+            record_fields, for machine-readable output.
+        """
+        return [ self.id, self.release, self.type, self.status, self.prio,
+                 self.weight, self.date.strftime(DATE_FORMAT),
+                 self.assigned_to, self.issuer, self.title ]
+
     def __str__(self):
         headers = [ 'Subject: %s'     % self.title,
                                 'Issuer: %s'      % self.issuer,
@@ -302,11 +377,13 @@ class Ticket:
         print('')
         print(self.body)
 
-    def filename(self):
-        file = os.path.join(self.working_dir, it.TICKET_DIR, self.release, self.id)
-        return file
+    def path(self, layout = it.FLAT_LAYOUT):
+        """ Returns the path of this ticket relative to the itdb branch root
+            in storage `layout`.
+        """
+        return ticket_path(self.release, self.id, layout)
 
-    def save(self, filename = None):
+    def contents(self):
         headers = [ 'Subject: %s'     % self.title,
                                 'Issuer: %s'      % self.issuer,
                                 'Date: %s'        % self.date.strftime(DATE_FORMAT),
@@ -318,11 +395,10 @@ class Ticket:
                                 '',
                                 self.body
                             ]
-        contents = os.linesep.join(headers)
+        return os.linesep.join(headers)
 
-        # If an explicit file name is not given, calculate the default
-        if filename is None:
-            filename = self.filename()
+    def save(self, filename):
+        contents = self.contents()
 
         # Write the file
         dir, _ = os.path.split(filename)
@@ -332,6 +408,6 @@ class Ticket:
         try:
             f.write(contents)
         finally:
-            f.close
+            f.close()
 
 
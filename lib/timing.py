@@ -0,0 +1,117 @@
+#vim: syntax=python fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4
+#
+# Wall-clock timing of the phases of a subcommand, for 'it --profile'.
+#
+# Code marks where time is spent with 'with timing.phase(<name>):'. Phases
+# may nest; time is always booked on the innermost phase only, so the phases
+# of a run add up to its total time. When timing is not enabled, phase()
+# costs a single attribute check.
+#
+import sys
+import time
+import cProfile
+
+# Phases in the order they are reported, when they occurred
+PHASES = [ 'startup', 'import', 'repo open', 'tree walk', 'blob reads',
+           'parse', 'sort', 'render', 'commit' ]
+
+enabled = False
+
+_start = None
+_totals = {}
+_counts = {}
+_stack = []
+
+
+class _Phase(object):
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        now = time.time()
+        if _stack:
+            _book(_stack[-1], now)
+        self.started = now
+        _stack.append(self)
+        _counts[self.name] = _counts.get(self.name, 0) + 1
+
+    def __exit__(self, *exc_info):
+        now = time.time()
+        _book(_stack.pop(), now)
+        if _stack:
+            _stack[-1].started = now
+        return False
+
+
+class _NoPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_PHASE = _NoPhase()
+
+
+def _book(phase, now):
+    _totals[phase.name] = _totals.get(phase.name, 0.0) + now - phase.started
+
+
+def enable(start = None):
+    """ Starts timing. `start` is the time the process started doing work,
+        which is booked as the 'startup' phase.
+    """
+    global enabled, _start
+    enabled = True
+    now = time.time()
+    _start = start or now
+    _totals['startup'] = now - _start
+    _counts['startup'] = 1
+
+
+def phase(name):
+    """ Returns a context manager that books the time spent in it on `name`.
+    """
+    if not enabled:
+        return _NO_PHASE
+    return _Phase(name)
+
+
+def profile(func, filename):
+    """ Runs `func` under cProfile and writes the profile data to `filename`
+        and the time spent per phase to stderr, also when `func` exits.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        func()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+        report()
+        sys.stderr.write("cProfile data written to '%s' (see 'python -m pstats')\n"
+                % filename)
+
+
+def report(stream = None):
+    """ Writes the time spent per phase, and the total, to `stream`.
+    """
+    stream = stream or sys.stderr
+    total = time.time() - _start
+    names = [p for p in PHASES if p in _totals] + \
+            sorted([p for p in _totals if p not in PHASES])
+    stream.write('\n%-12s %10s %8s %6s\n' % ('phase', 'ms', 'calls', '%'))
+    for name in names + ['other']:
+        if name == 'other':
+            seconds, count = total - sum(_totals.values()), ''
+        else:
+            seconds, count = _totals[name], _counts[name]
+        stream.write('%-12s %10.1f %8s %5.1f%%\n' % (name, seconds * 1000,
+                count, total and seconds / total * 100 or 0))
+    stream.write('%-12s %10.1f\n' % ('total', total * 1000))
+
+#EOF